@@ -0,0 +1,102 @@
+'''
+Learner throughput on synthetic batches, without buffer or actors
+
+    python benchmark.py --batch-size 128 256 --bt-steps 16 32 --cnn-channel 64 128
+
+Every combination runs Learner.learn on batches shaped like GlobalBuffer.sample_batch and reports
+updates/s and mean time of each phase. --profile writes a torch profiler trace of the timed updates.
+A window of a real training run is profiled with config.profile_window instead.
+'''
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+import torch
+
+import config
+# learner is created in this process, runtime.put only has to wrap weights
+config.runtime = 'local'
+from worker import Learner
+from metrics import Metrics
+
+
+def synthetic_batch(batch_size:int, bt_steps:int, forward_steps:int):
+    '''random batch in the layout of GlobalBuffer.sample_batch, sorted by sequence length the same way'''
+    b_bt_steps = np.random.randint(1, bt_steps+1, batch_size)
+    b_steps = np.random.randint(1, forward_steps+1, batch_size)
+    order = np.lexsort((-b_bt_steps, -(b_bt_steps+b_steps)))
+    b_bt_steps, b_steps = b_bt_steps[order], b_steps[order]
+
+    return (
+        torch.randint(0, 2, (batch_size, bt_steps+forward_steps, *config.obs_shape)).float(),
+        torch.randint(0, 5, (batch_size, 1)),
+        torch.randn(batch_size, 1),
+
+        torch.zeros(batch_size, 1),
+        torch.from_numpy(b_steps.astype(np.float32)).unsqueeze(1),
+        b_bt_steps.tolist(),
+        torch.randn(batch_size, config.latent_dim),
+        torch.zeros(batch_size, 1),
+        np.full(batch_size, -1, dtype=np.int32),
+
+        np.arange(batch_size),
+        torch.ones(batch_size, 1),
+        0
+    )
+
+
+def benchmark(batch_size:int, bt_steps:int, forward_steps:int, cnn_channel:int, updates:int, warmup:int, profile_path:str=None):
+    config.batch_size, config.bt_steps, config.forward_steps, config.cnn_channel = batch_size, bt_steps, forward_steps, cnn_channel
+
+    learner = Learner.cls(None)
+    batches = [ synthetic_batch(batch_size, bt_steps, forward_steps) for _ in range(4) ]
+
+    for i in range(warmup):
+        learner.learn(batches[i%4])
+    learner.metrics = Metrics('learner')
+
+    profiler = learner.start_profiler() if profile_path is not None else None
+
+    start = time.perf_counter()
+    for i in range(1, updates+1):
+        learner.learn(batches[i%4])
+        if i % 5 == 0:
+            learner.store_weights()
+        if profiler is not None:
+            profiler.step()
+    if learner.device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter()-start
+
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(profile_path, exist_ok=True)
+        path = os.path.join(profile_path, 'benchmark_{}_{}_{}_{}.json'.format(batch_size, bt_steps, forward_steps, cnn_channel))
+        profiler.export_chrome_trace(path)
+        print('profiler trace saved to {}'.format(path))
+
+    phases = learner.metrics.histograms
+    print('batch_size {} bt_steps {} forward_steps {} cnn_channel {}: {:.2f} updates/s'.format(
+            batch_size, bt_steps, forward_steps, cnn_channel, updates/elapsed))
+    for name, histogram in phases.items():
+        print('    {:<16} {:8.3f} ms/call, {:5.1f}%'.format(name, 1000*histogram.sum/histogram.count, 100*histogram.sum/elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[config.batch_size])
+    parser.add_argument('--bt-steps', type=int, nargs='+', default=[config.bt_steps])
+    parser.add_argument('--forward-steps', type=int, nargs='+', default=[config.forward_steps])
+    parser.add_argument('--cnn-channel', type=int, nargs='+', default=[config.cnn_channel])
+    parser.add_argument('--updates', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--profile', type=str, default=None, help='directory of profiler traces')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    for batch_size, bt_steps, forward_steps, cnn_channel in itertools.product(args.batch_size, args.bt_steps, args.forward_steps, args.cnn_channel):
+        benchmark(batch_size, bt_steps, forward_steps, cnn_channel, args.updates, args.warmup, args.profile)
@@ -5,11 +5,31 @@ from numba import int32, float32
 import torch
 import math
 from dataclasses import dataclass
+from multiprocessing import shared_memory, resource_tracker
 
 import config
 
 discounts = np.array([ 0.99**i for i in range(config.max_steps)])
 
+obs_size = int(np.prod(config.obs_shape))
+
+def obs_storage():
+    '''shape and dtype of one observation in replay'''
+    if config.obs_dtype == 'packed':
+        return ((obs_size+7)//8,), np.uint8
+    return config.obs_shape, np.bool
+
+def encode_obs(obs:np.ndarray):
+    '''bool observations (steps, *obs_shape) to replay storage, 8 per byte if obs_dtype is packed'''
+    if config.obs_dtype == 'packed':
+        return np.packbits(obs.reshape(obs.shape[0], -1), axis=1)
+    return obs
+
+def decode_obs(rows:np.ndarray):
+    if config.obs_dtype == 'packed':
+        return np.unpackbits(rows, axis=1, count=obs_size).reshape(-1, *config.obs_shape).view(np.bool)
+    return rows
+
 def quantile_huber_loss(curr_dist, target_dist, kappa=1.0):
     curr_dist = np.expand_dims(curr_dist, 1)
     target_dist = np.expand_dims(target_dist, 0)
@@ -122,8 +142,239 @@ class SumTree:
         assert np.sum(self.tree[-self.capacity:])-self.tree[0] < 0.1, 'sum is {} but root is {}'.format(np.sum(self.tree[-self.capacity:]), self.tree[0])
 
 
+class SharedArrays:
+    def __init__(self):
+        '''
+        Numpy arrays in named shared memory, attached by name from other processes on the same machine.
+        The creating process owns the memory and unlinks it on close
+        '''
+        self.blocks = dict()
+        self.arrays = dict()
+        # name: (shared memory name, shape, dtype)
+        self.specs = dict()
+        self.owner = True
+
+    def create(self, name:str, shape:tuple, dtype):
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array[...] = 0
+
+        self.blocks[name] = block
+        self.arrays[name] = array
+        self.specs[name] = (block.name, shape, dtype.str)
+        return array
+
+    @staticmethod
+    def attach(specs:dict):
+        shared = SharedArrays()
+        shared.owner = False
+        for name, (block_name, shape, dtype) in specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            # only the owner unlinks, resource tracker of this process would unlink at exit
+            resource_tracker.unregister(block._name, 'shared_memory')
+            shared.blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            shared.specs[name] = (block_name, shape, dtype)
+        return shared
+
+    def close(self):
+        self.arrays = dict()
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                try:
+                    block.unlink()
+                except FileNotFoundError:
+                    # already removed by SharedArrays.unlink
+                    pass
+        self.blocks = dict()
+
+    @staticmethod
+    def unlink(specs:dict):
+        '''remove shared memory of specs from another process, for when the owner was killed before close'''
+        for block_name, _, _ in specs.values():
+            try:
+                block = shared_memory.SharedMemory(name=block_name)
+            except FileNotFoundError:
+                continue
+            block.close()
+            block.unlink()
+
+
+class HiddenStore:
+    def __init__(self, capacity, interval=config.hidden_interval, dtype=config.hidden_dtype):
+        '''
+        Recurrent states for global buffer, only the state after every `interval` steps of an episode
+        is kept as burn-in start. bfloat16 is stored as the upper 16 bits of float32
+        '''
+        assert 1 <= interval <= config.bt_steps, 'hidden interval should be in [1, bt_steps]'
+        assert dtype in ('float32', 'float16', 'bfloat16'), 'hidden dtype does not support'
+
+        self.interval = interval
+        self.dtype = dtype
+        self.slot_len = math.ceil(config.max_steps/interval)
+        storage_dtype = np.uint16 if dtype == 'bfloat16' else np.dtype(dtype)
+        self.buf = np.zeros((capacity*self.slot_len, config.latent_dim), dtype=storage_dtype)
+
+    def encode(self, hidden:np.ndarray):
+        if self.dtype == 'bfloat16':
+            bits = hidden.astype(np.float32).view(np.uint32)
+            # round to nearest even
+            return ((bits + 0x7fff + ((bits>>16) & 1)) >> 16).astype(np.uint16)
+        else:
+            return hidden.astype(self.buf.dtype)
+
+    def decode(self, hidden:np.ndarray):
+        if self.dtype == 'bfloat16':
+            return (hidden.astype(np.uint32) << 16).view(np.float32)
+        else:
+            return hidden.astype(np.float32)
+
+    def add(self, slot:int, hidden:np.ndarray):
+        '''hidden is already subsampled by LocalBuffer.finish'''
+        start_idx = slot*self.slot_len
+        self.buf[start_idx:start_idx+hidden.shape[0]] = self.encode(hidden)
+
+    def start_step(self, local_idx:int):
+        '''
+        step whose hidden state starts the burn-in of transition local_idx, -1 for zero state
+        burn-in steps is local_idx - start step
+        '''
+        if local_idx < config.bt_steps:
+            return -1
+        return -(-(local_idx-config.bt_steps)//self.interval) * self.interval
+
+    def get(self, slot:int, step:int):
+        if step == -1:
+            return np.zeros(config.latent_dim, dtype=np.float32)
+        return self.decode(self.buf[slot*self.slot_len+step//self.interval])
+
+
+class ObsPool:
+    def __init__(self, obs:np.ndarray):
+        '''
+        Deduplicated observation rows of global buffer, replay steps hold uint32 handles into obs.
+        Equal rows share one handle, found by hash of their bytes and checked for equality. A row is
+        freed once no step refers to it
+        '''
+        self.obs = obs
+        self.refcount = np.zeros(obs.shape[0], dtype=np.int32)
+        self.keys = np.zeros(obs.shape[0], dtype=np.int64)
+        # rows reachable from table, a row whose hash collides with another is stored but not shared
+        self.indexed = np.zeros(obs.shape[0], dtype=np.bool)
+        self.table = dict()
+        self.free = list(range(obs.shape[0]-1, -1, -1))
+        # rows whose observation or refcount changed since last take_dirty
+        self.dirty = np.zeros(obs.shape[0], dtype=np.bool)
+
+        # observations added and those stored in a new row
+        self.inserted = 0
+        self.stored = 0
+
+    def num_free(self):
+        return len(self.free)
+
+    def add(self, rows:np.ndarray):
+        '''store rows, return their handles'''
+        handles = np.empty(rows.shape[0], dtype=np.uint32)
+        for i, row in enumerate(rows):
+            key = hash(row.tobytes())
+            handle = self.table.get(key)
+            if handle is None or not np.array_equal(self.obs[handle], row):
+                handle = self.free.pop()
+                self.obs[handle] = row
+                self.stored += 1
+                if key not in self.table:
+                    self.table[key] = handle
+                    self.keys[handle] = key
+                    self.indexed[handle] = True
+            self.refcount[handle] += 1
+            handles[i] = handle
+
+        self.dirty[handles] = True
+        self.inserted += rows.shape[0]
+        return handles
+
+    def release(self, handles:np.ndarray):
+        np.subtract.at(self.refcount, handles, 1)
+        self.dirty[handles] = True
+        for handle in np.unique(handles[self.refcount[handles] == 0]).tolist():
+            if self.indexed[handle]:
+                del self.table[self.keys[handle].item()]
+                self.indexed[handle] = False
+            self.free.append(handle)
+
+    def rebuild(self):
+        '''table and free rows from obs and refcount, after restoring them'''
+        self.table = dict()
+        self.indexed[:] = False
+        self.dirty[:] = False
+        self.free = []
+        for handle in range(self.obs.shape[0]-1, -1, -1):
+            if self.refcount[handle] == 0:
+                self.free.append(handle)
+                continue
+            key = hash(self.obs[handle].tobytes())
+            if key not in self.table:
+                self.table[key] = handle
+                self.keys[handle] = key
+                self.indexed[handle] = True
+
+    def take_dirty(self):
+        '''rows changed since last call'''
+        rows = np.flatnonzero(self.dirty)
+        self.dirty[rows] = False
+        return rows
+
+    def dedup_rate(self):
+        '''fraction of added observations that share an existing row'''
+        return 1 - self.stored / self.inserted if self.inserted else 0.0
+
+
+class RateLimiter:
+    def __init__(self, samples_per_insert=config.samples_per_insert, min_size=config.learning_starts,
+                error_buffer=config.rate_error_buffer):
+        '''
+        Keep sampled transitions close to samples_per_insert times the transitions inserted after min_size,
+        inserts are blocked once the learner falls more than error_buffer samples behind and sampling is
+        blocked once it runs more than error_buffer samples ahead. samples_per_insert None disables it
+        '''
+        self.samples_per_insert = samples_per_insert
+        self.min_size = min_size
+        self.error_buffer = error_buffer
+        self.inserted = 0
+        self.sampled = 0
+
+    def insert(self, num:int):
+        self.inserted += num
+
+    def sample(self, num:int):
+        self.sampled += num
+
+    def diff(self):
+        '''samples owed to the learner, negative if it runs ahead'''
+        return max(self.inserted-self.min_size, 0)*self.samples_per_insert - self.sampled
+
+    def can_insert(self):
+        if self.samples_per_insert is None or self.inserted < self.min_size:
+            return True
+        return self.diff() <= self.error_buffer
+
+    def can_sample(self, num:int):
+        if self.inserted < self.min_size:
+            return False
+        if self.samples_per_insert is None:
+            return True
+        return self.diff()-num >= -self.error_buffer
+
+    def ratio(self):
+        '''observed samples per insert since min_size'''
+        return self.sampled / max(self.inserted-self.min_size, 1)
+
+
 class LocalBuffer:
-    __slots__ = ('actor_id', 'map_len', 'num_agents', 'obs_buf', 'act_buf', 'rew_buf', 'hid_buf', 'cell_buf', 'q_buf',
+    __slots__ = ('actor_id', 'map_len', 'num_agents', 'obs_buf', 'act_buf', 'rew_buf', 'hid_buf', 'q_buf',
                     'capacity', 'size', 'done', 'td_errors')
     def __init__(self, actor_id, num_agents, map_len, init_obs, size=config.max_steps):
         """
@@ -152,7 +403,7 @@ class LocalBuffer:
         return self.size
 
 
-    def add(self, q_val:np.ndarray, action:int, reward:float, next_obs:np.ndarray, hidden):
+    def add(self, q_val:np.ndarray, action:int, reward:float, next_obs:np.ndarray, hidden:np.ndarray):
 
         assert self.size < self.capacity
 
@@ -160,8 +411,7 @@ class LocalBuffer:
         self.rew_buf[self.size] = reward
         self.obs_buf[self.size+1] = next_obs
         self.q_buf[self.size] = q_val
-        self.hid_buf[self.size] = hidden[0]
-        self.cell_buf[self.size] = hidden[1]
+        self.hid_buf[self.size] = hidden
 
         self.size += 1
 
@@ -173,11 +423,11 @@ class LocalBuffer:
             self.done = False
             self.q_buf[self.size] = last_q_val
         
-        self.obs_buf = self.obs_buf[:self.size+1]
+        self.obs_buf = encode_obs(self.obs_buf[:self.size+1])
         self.act_buf = self.act_buf[:self.size]
         self.rew_buf = self.rew_buf[:self.size]
-        self.hid_buf = self.hid_buf[:self.size]
-        self.cell_buf = self.cell_buf[:self.size]
+        # only keep hidden states that can start a burn-in
+        self.hid_buf = self.hid_buf[:self.size:config.hidden_interval]
         self.q_buf = self.q_buf[:self.size+1]
 
 
@@ -190,4 +440,4 @@ class LocalBuffer:
         q_val = self.q_buf[np.arange(self.size), self.act_buf]
         self.td_errors[:self.size] = np.abs(reward-q_val)
 
-        return  self.actor_id, self.num_agents, self.map_len, self.obs_buf, self.act_buf, self.rew_buf, self.hid_buf, self.cell_buf, self.td_errors, self.done, self.size
+        return  self.actor_id, self.num_agents, self.map_len, self.obs_buf, self.act_buf, self.rew_buf, self.hid_buf, self.td_errors, self.done, self.size
@@ -0,0 +1,131 @@
+'''
+Learner checkpoints written by a background thread
+
+    save_path/
+        index.json      retained checkpoints oldest first, latest and best, replaced after every write
+        <updates>.pth   full training state, model with arch, target model, optimizer, scheduler and counters
+        best.pth        arch and weights with the best evaluation result
+
+Every file is written under a temporary name and renamed, so readers never see a partial file and
+the index only names complete ones. Files are in the zip format of torch.save, load_checkpoint maps
+their tensors with torch.load(mmap=True) instead of reading them. Only the last keep_checkpoints
+numbered checkpoints are kept.
+'''
+import json
+import os
+import queue
+import threading
+import time
+
+import torch
+
+import config
+
+
+def snapshot(obj):
+    '''copy of nested state dicts with tensors on cpu, so training can go on while it is written'''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return { key: snapshot(value) for key, value in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def save_atomic(obj, path:str):
+    torch.save(obj, path+'.tmp')
+    with open(path+'.tmp', 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(path+'.tmp', path)
+
+
+def read_index(path:str=config.save_path):
+    index_path = os.path.join(path, 'index.json')
+    if not os.path.exists(index_path):
+        return {'checkpoints': [], 'latest': None, 'best': None}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def latest_checkpoint(path:str=config.save_path):
+    '''path of the latest checkpoint in index, None if there is none'''
+    latest = read_index(path)['latest']
+    return os.path.join(path, latest) if latest is not None else None
+
+
+def load_checkpoint(path:str, device=torch.device('cpu')):
+    return torch.load(path, map_location=device, mmap=True, weights_only=False)
+
+
+class CheckpointWriter:
+    def __init__(self, path:str=config.save_path, keep:int=config.keep_checkpoints):
+        self.path = path
+        self.keep = keep
+        # continues the index of a resumed run
+        self.index = read_index(path)
+
+        # at most one checkpoint waits while another is written, submit blocks beyond that
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, counter:int, state:dict):
+        '''state of snapshot, not modified afterwards'''
+        self.queue.put(('checkpoint', counter, state, None))
+
+    def submit_best(self, counter:int, state:dict, result:dict):
+        self.queue.put(('best', counter, state, result))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            kind, counter, state, result = item
+            start = time.time()
+            if kind == 'checkpoint':
+                removed = self.write_checkpoint(counter, state)
+            else:
+                removed = self.write_best(counter, state, result)
+            self.write_index()
+
+            # files leave the index before they are removed
+            for name in removed:
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+
+            print('checkpoint {} of {} updates written in {:.2f}s'.format(kind, counter, time.time()-start))
+            self.queue.task_done()
+
+    def write_checkpoint(self, counter:int, state:dict):
+        name = '{}.pth'.format(counter)
+        save_atomic(state, os.path.join(self.path, name))
+
+        checkpoints = [ entry for entry in self.index['checkpoints'] if entry['file'] != name ]
+        checkpoints.append({'file': name, 'updates': counter, 'time': time.time()})
+        self.index['checkpoints'] = checkpoints[-self.keep:]
+        self.index['latest'] = name
+
+        return [ entry['file'] for entry in checkpoints[:-self.keep] ]
+
+    def write_best(self, counter:int, state:dict, result:dict):
+        save_atomic(state, os.path.join(self.path, 'best.pth'))
+        self.index['best'] = {'file': 'best.pth', 'updates': counter, 'time': time.time(), **result}
+        return []
+
+    def write_index(self):
+        index_path = os.path.join(self.path, 'index.json')
+        with open(index_path+'.tmp', 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(index_path+'.tmp', index_path)
+
+    def flush(self):
+        '''wait until submitted checkpoints are written'''
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -13,11 +13,21 @@ reward_fn = dict(move=-0.075,
 
 obs_shape = (6,9,9)
 
+# dense: navigation channels of all agents materialized at reset
+# compact: one uint16 distance field per distinct goal, channels derived in observe
+navi_backend = 'dense'
+
+# lifelong mapf, agents get a new goal once they reach one
+lifelong = False
+
 
 ############################################################
 ####################         DQN        ####################
 ############################################################
 
+# ray: ray actors, local: forked processes with shared memory queues on this machine
+runtime = 'ray'
+
 # basic training setting
 training_times = 1000000
 save_interval=2500
@@ -26,15 +36,75 @@ batch_size=256
 learning_starts=50000
 target_network_update_freq=2500
 save_path='./models'
+# numbered checkpoints kept in save_path besides the best evaluated one
+keep_checkpoints = 5
 max_steps = 256
 bt_steps = 32
-load_model = None
+load_model = None # checkpoint path, or latest in the index of save_path
+
+# replay buffer snapshot, restored together with load_model
+buffer_snapshot_path = './buffer'
+buffer_snapshot_interval = 600
+buffer_snapshot_chunk = 64 # slots copied per hold of the buffer lock
 
 local_buffer_size = max_steps
 global_buffer_size = 1024*local_buffer_size
 
+# episode slots of global buffer, power of 2
+# None to use the largest capacity within buffer_memory_budget, which also bounds an explicit capacity
+buffer_capacity = 2048
+buffer_memory_budget = None # bytes, e.g. 16*2**30
+# bool, or packed to store 8 observation channels per byte
+obs_dtype = 'bool'
+
+# store each distinct observation once in a pool that replay steps refer to by uint32 handles
+# the pool has obs_pool_ratio rows per replay step, oldest episodes leave early when it is full
+obs_dedup = False
+obs_pool_ratio = 0.5
+
+# processes that assemble batches from replay arrays in shared memory, 0 to assemble in a global buffer thread
+num_samplers = 0
+
 actor_update_steps = 400
 
+# replay ratio, sampled transitions per inserted transition once learning starts (None to disable)
+# actors pause when the learner falls rate_error_buffer samples behind, sampling pauses when it runs ahead
+samples_per_insert = None # e.g. 8
+rate_error_buffer = 100*batch_size
+# episodes an actor may have in flight to the global buffer
+max_inflight_adds = 2
+
+# actors, None for one per core left after learners, global buffer and samplers (see resources.py)
+num_actors = None
+# torch threads and cores of each learner, None for 2 with a gpu and a quarter of the cores otherwise
+learner_threads = None
+# pin every process to its planned cores, otherwise only torch threads are set
+pin_cpus = True
+
+# encoder outputs of repeated observations kept by actors and evaluator, None to encode every observation
+encoder_cache_size = None # e.g. 4096
+
+# environment groups per actor, with 2 or more inference of one group overlaps stepping of another
+actor_env_groups = 1
+
+# stage timing histograms, exported in prometheus text format every stats interval
+metrics_path = './metrics.prom'
+metrics_port = None # also serve at http://localhost:metrics_port/metrics if set
+# torch profiler trace of learner updates in [start, end), None to disable
+profile_window = None
+profile_path = './profile'
+
+# greedy evaluation of published weights on fixed test suites while training, None to disable
+eval_interval = None # learner updates between evaluations, e.g. 10000
+eval_tests = ('test16_40_0.3.pkl',)
+eval_batch_envs = 50 # cases stepped together in one forward pass
+eval_log_path = './eval.jsonl'
+
+# data parallel learners, gradients are all-reduced over gloo
+# rank 0 publishes weights and saves models
+num_learners = 1
+learner_dist_url = 'tcp://127.0.0.1:29500'
+
 # gradient norm clipping
 grad_norm_dqn=40
 
@@ -49,12 +119,24 @@ prioritized_replay_beta=0.4
 # use double q learning
 double_q = False
 
+# keep target bootstrap values in replay buffer, recompute them only after a target network update
+# not used with double q learning, whose target depends on the online network
+cache_target_q = False
+
 # adaptive learning
 init_set = (1, 10)
 max_num_agetns = 16
 max_map_lenght = 40
 pass_rate = 0.9
+# episodes of a level its pass rate is measured over
+curriculum_window = 200
 
 # dqn network setting
 cnn_channel = 128
 latent_dim = 256
+
+# recurrent state storage in replay buffer
+# only the state every hidden_interval steps is kept as burn-in start, so burn-in length
+# varies in (bt_steps-hidden_interval, bt_steps]
+hidden_interval = 4
+hidden_dtype = 'float16' # float32, float16 or bfloat16
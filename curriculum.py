@@ -0,0 +1,104 @@
+'''
+Curriculum of (num_agents, map_length) levels
+
+Outcomes of the last curriculum_window episodes of each level are kept in a ring so recording
+one is O(1). A level passed at pass_rate is replaced by its harder neighbours. Every change of
+the level set increases the version, so actors only fetch levels again when it changed.
+'''
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import config
+
+
+class LevelStats:
+    __slots__ = ('outcomes', 'ptr', 'count', 'successes')
+    def __init__(self, window:int=config.curriculum_window):
+        self.outcomes = np.zeros(window, dtype=np.bool)
+        self.ptr = 0
+        self.count = 0
+        self.successes = 0
+
+    def record(self, success:bool):
+        if self.count == self.outcomes.shape[0]:
+            self.successes -= int(self.outcomes[self.ptr])
+        else:
+            self.count += 1
+        self.outcomes[self.ptr] = success
+        self.successes += int(success)
+        self.ptr = (self.ptr+1) % self.outcomes.shape[0]
+
+    def full(self):
+        return self.count == self.outcomes.shape[0]
+
+    def passed(self):
+        return self.full() and self.successes >= self.count*config.pass_rate
+
+    def to_list(self):
+        '''outcomes oldest first'''
+        if self.full():
+            return np.roll(self.outcomes, -self.ptr).tolist()
+        return self.outcomes[:self.count].tolist()
+
+
+class Curriculum:
+    def __init__(self, init_level:Tuple[int, int]=config.init_set):
+        self.levels = {init_level: LevelStats()}
+        self.version = 0
+
+    def record(self, num_agents:int, map_length:int, success:bool):
+        stats = self.levels.get((num_agents, map_length))
+        # episodes of levels removed since the actor fetched them are dropped
+        if stats is not None:
+            stats.record(success)
+
+    def update(self):
+        '''promote passed levels, return whether the level set changed'''
+        changed = False
+        for (num_agents, map_length), stats in list(self.levels.items()):
+            if not stats.passed():
+                continue
+
+            # add number of agents
+            if num_agents+1 <= config.max_num_agetns and (num_agents+1, map_length) not in self.levels:
+                self.levels[(num_agents+1, map_length)] = LevelStats()
+                changed = True
+
+            if map_length < config.max_map_lenght:
+                if (num_agents, map_length+5) not in self.levels:
+                    self.levels[(num_agents, map_length+5)] = LevelStats()
+                del self.levels[(num_agents, map_length)]
+                changed = True
+
+        if changed:
+            self.version += 1
+        return changed
+
+    def level_list(self) -> List[Tuple[int, int]]:
+        return list(self.levels.keys())
+
+    def done(self):
+        '''all agent numbers passed on the largest map'''
+        for num_agents in range(1, config.max_num_agetns+1):
+            stats = self.levels.get((num_agents, config.max_map_lenght))
+            if stats is None or not stats.passed():
+                return False
+        return True
+
+    def state(self) -> Dict[Tuple[int, int], List[bool]]:
+        return { level: stats.to_list() for level, stats in self.levels.items() }
+
+    def load_state(self, state:Dict[Tuple[int, int], List[bool]]):
+        '''from state or the per level outcome lists of older buffer snapshots'''
+        self.levels = dict()
+        for level, outcomes in state.items():
+            stats = LevelStats()
+            for success in outcomes[-stats.outcomes.shape[0]:]:
+                stats.record(success)
+            self.levels[level] = stats
+        self.version += 1
+
+    def summary(self):
+        for level, stats in self.levels.items():
+            print('{}: {}/{}'.format(level, stats.successes, stats.count))
@@ -0,0 +1,146 @@
+'''
+Distill a trained network into a smaller student for low latency inference
+
+    python distill.py --teacher ./models/462500.pth --cnn-channel 32 --num-blocks 1 --latent-dim 64 --depthwise
+
+Rollouts are acted by the teacher or, with probability --student-act, by the student so that the student
+also learns on states it visits itself. Every observation is labeled with teacher q values. The student
+is saved with its architecture and can be loaded by model.load_network, it has the same step interface.
+'''
+import argparse
+import pickle
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.optim import Adam
+
+import config
+from environment import Environment
+from evaluation import evaluate
+from model import Network, load_network
+
+
+def rollout(teacher:Network, student:Network, env:Environment, level:tuple, student_act:bool, device):
+    '''run one episode, return observations (num_agents, steps, *obs_shape) and teacher q values (num_agents, steps, 5)'''
+    obs = env.reset(num_agents=level[0], map_length=level[1])
+    teacher.reset()
+    student.reset()
+
+    b_obs, b_q = [], []
+    done = False
+    while not done and env.steps < config.max_steps:
+        obs_tensor = torch.from_numpy(obs.astype(np.float32)).to(device)
+        actions, q_val, _ = teacher.step(obs_tensor)
+        if student_act:
+            actions, _, _ = student.step(obs_tensor)
+
+        b_obs.append(obs)
+        b_q.append(q_val)
+
+        obs, _, done, _ = env.step(actions)
+
+    return np.stack(b_obs, axis=1), np.stack(b_q, axis=1)
+
+
+def sample_batch(episodes:list, batch_size:int, seq_len:int, burn_in:int):
+    '''
+    windows of seq_len steps after up to burn_in steps without loss, padded at the end,
+    return obs (batch, burn_in+seq_len, *obs_shape), teacher q and loss mask
+    '''
+    length = burn_in+seq_len
+    b_obs = np.zeros((batch_size, length, *config.obs_shape), dtype=np.bool)
+    b_q = np.zeros((batch_size, length, 5), dtype=np.float32)
+    b_mask = np.zeros((batch_size, length), dtype=np.float32)
+
+    for i in range(batch_size):
+        obs, q_val = random.choice(episodes)
+        agent_id = random.randrange(obs.shape[0])
+        steps = obs.shape[1]
+
+        start = random.randint(0, max(steps-seq_len, 0))
+        bt_steps = min(start, burn_in)
+        end = min(start+seq_len, steps)
+
+        b_obs[i, :end-start+bt_steps] = obs[agent_id, start-bt_steps:end]
+        b_q[i, :end-start+bt_steps] = q_val[agent_id, start-bt_steps:end]
+        b_mask[i, bt_steps:end-start+bt_steps] = 1
+
+    return torch.from_numpy(b_obs.astype(np.float32)), torch.from_numpy(b_q), torch.from_numpy(b_mask)
+
+
+def distill(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    teacher = load_network(args.teacher, device)
+    student = Network(cnn_channel=args.cnn_channel, num_blocks=args.num_blocks, latent_dim=args.latent_dim, depthwise=args.depthwise)
+    student.to(device)
+    optimizer = Adam(student.parameters(), lr=args.lr)
+
+    env = Environment()
+    levels = [ (num_agents, map_length) for num_agents in args.num_agents for map_length in args.map_length ]
+    episodes = []
+
+    for iteration in range(1, args.iterations+1):
+        student.eval()
+        with torch.no_grad():
+            for _ in range(args.episodes):
+                episodes.append(rollout(teacher, student, env, random.choice(levels), random.random() < args.student_act, device))
+        episodes = episodes[-args.replay_size:]
+
+        student.train()
+        for _ in range(args.updates):
+            b_obs, b_q, b_mask = sample_batch(episodes, args.batch_size, args.seq_len, config.bt_steps)
+            b_obs, b_q, b_mask = b_obs.to(device), b_q.to(device), b_mask.to(device)
+
+            q_val, _ = student(b_obs)
+
+            # match teacher action distribution and q values
+            kl = F.kl_div(F.log_softmax(q_val/args.temperature, 2), F.softmax(b_q/args.temperature, 2), reduction='none').sum(2)
+            mse = (q_val-b_q).pow(2).mean(2)
+            loss = ((kl*args.temperature**2 + args.mse_weight*mse) * b_mask).sum() / b_mask.sum()
+
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), config.grad_norm_dqn)
+            optimizer.step()
+
+        print('iteration {}: loss {:.4f}, {} episodes'.format(iteration, loss.item(), len(episodes)))
+
+    torch.save({'arch': student.arch, 'state_dict': student.state_dict()}, args.output)
+    print('student saved to {}'.format(args.output))
+
+    student.eval()
+    for test_case in args.tests:
+        with open(test_case, 'rb') as f:
+            tests = pickle.load(f)
+
+        for name, network in (('teacher', teacher), ('student', student)):
+            result = evaluate(network, tests, device)
+            print('{} {}: finish {:.4f}, mean steps {:.2f}, latency {:.3f} ms/step'.format(test_case, name,
+                    result['success_rate'], result['mean_steps'], result['latency']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teacher', type=str, required=True)
+    parser.add_argument('--output', type=str, default='./models/student.pth')
+    parser.add_argument('--cnn-channel', type=int, default=32)
+    parser.add_argument('--num-blocks', type=int, default=1)
+    parser.add_argument('--latent-dim', type=int, default=64)
+    parser.add_argument('--depthwise', action='store_true')
+    parser.add_argument('--num-agents', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--map-length', type=int, nargs='+', default=[20, 30, 40])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--episodes', type=int, default=8)
+    parser.add_argument('--updates', type=int, default=50)
+    parser.add_argument('--replay-size', type=int, default=2000)
+    parser.add_argument('--student-act', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--seq-len', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--mse-weight', type=float, default=0.1)
+    parser.add_argument('--tests', type=str, nargs='+', default=['test16_40_0.3.pkl'])
+    distill(parser.parse_args())
@@ -1,9 +1,6 @@
 import numpy as np
-
-import matplotlib.pyplot as plt
-plt.ion()
-from matplotlib import colors
 import random
+import heapq
 from typing import List, Union
 
 import config
@@ -68,12 +65,180 @@ def map_partition(map):
         partition_list.append(close_list)
 
     return partition_list
-    
+
+
+def bfs_distance(map:np.ndarray, goal:tuple, dtype=np.int32):
+    '''
+    shortest path length from each cell to goal, obstacles and unreachable cells get the max value of dtype
+    expand the whole wavefront with array shifts instead of visiting cells one by one
+    '''
+    dist_map = np.full(map.shape, np.iinfo(dtype).max, dtype=dtype)
+    dist_map[goal] = 0
+
+    free = map==0
+    visited = np.zeros(map.shape, dtype=np.bool)
+    visited[goal] = True
+    frontier = visited.copy()
+    dist = 0
+
+    while True:
+        next_frontier = np.zeros(map.shape, dtype=np.bool)
+        next_frontier[1:] |= frontier[:-1]
+        next_frontier[:-1] |= frontier[1:]
+        next_frontier[:, 1:] |= frontier[:, :-1]
+        next_frontier[:, :-1] |= frontier[:, 1:]
+        next_frontier &= free
+        next_frontier &= ~visited
+
+        if not next_frontier.any():
+            return dist_map
+
+        dist += 1
+        dist_map[next_frontier] = dist
+        visited |= next_frontier
+        frontier = next_frontier
+
+
+def navi_channels(dist_map:np.ndarray, free:np.ndarray):
+    '''
+    dist_map is padded by one cell more than free, channel k is set if moving in direction k (up, down, left, right)
+    gets closer to goal
+    '''
+    center = dist_map[1:-1, 1:-1]
+    channels = np.stack((dist_map[:-2, 1:-1] < center, dist_map[2:, 1:-1] < center,
+                        dist_map[1:-1, :-2] < center, dist_map[1:-1, 2:] < center))
+    channels &= free
+
+    return channels
+
+
+class DistanceFields:
+    def __init__(self, map:np.ndarray, goals_pos:np.ndarray, obs_radius:int):
+        '''
+        Distance fields of each distinct goal, agents with the same goal share one field.
+        Fields are padded by obs_radius+1 so that observation windows and their neighbours stay in range.
+        '''
+        self.obs_radius = obs_radius
+        self.pad = obs_radius+1
+        self.map = map
+        # uint16 whose max is the unreachable value, a path through every free cell is shorter than it
+        # up to 256x256 maps since a map without obstacles has much shorter paths
+        self.dtype = np.uint16 if map.size <= np.iinfo(np.uint16).max+1 else np.int32
+        self.free = np.pad(map==0, self.pad, 'constant', constant_values=False)
+
+        self.fields = dict()
+        self.refs = dict()
+        self.agent_goals = [ None for _ in range(len(goals_pos)) ]
+
+        for agent_id, goal in enumerate(goals_pos):
+            self.set_goal(agent_id, goal)
+
+    def set_goal(self, agent_id:int, goal):
+        goal = tuple(int(i) for i in goal)
+        old_goal = self.agent_goals[agent_id]
+        if old_goal is not None:
+            self.refs[old_goal] -= 1
+            if self.refs[old_goal] == 0:
+                del self.refs[old_goal]
+                del self.fields[old_goal]
+
+        if goal not in self.fields:
+            dist_map = bfs_distance(self.map, goal, self.dtype)
+            self.fields[goal] = np.pad(dist_map, self.pad, 'constant', constant_values=np.iinfo(self.dtype).max)
+            self.refs[goal] = 0
+
+        self.refs[goal] += 1
+        self.agent_goals[agent_id] = goal
+
+    def window(self, agent_id:int, x:int, y:int):
+        '''navigation channels of the observation window centered at map position (x, y)'''
+        size = 2*self.obs_radius+1
+        dist_map = self.fields[self.agent_goals[agent_id]][x:x+size+2, y:y+size+2]
+
+        return navi_channels(dist_map, self.free[x+1:x+size+1, y+1:y+size+1])
+
+    def agent_navi_map(self, agent_id:int):
+        '''navigation channels of one agent on the whole map, padded by obs_radius'''
+        return navi_channels(self.fields[self.agent_goals[agent_id]], self.free[1:-1, 1:-1])
+
+    def navi_map(self):
+        return np.stack([ self.agent_navi_map(agent_id) for agent_id in range(len(self.agent_goals)) ])
+
+    def update_cell(self, pos:tuple):
+        '''
+        repair all fields after map[pos] is toggled, return the bounding box (x0, x1, y0, y1) of changed
+        cells in padded coordinates for each goal whose field changed
+        '''
+        pos = (pos[0]+self.pad, pos[1]+self.pad)
+        self.free[pos] = self.map[pos[0]-self.pad, pos[1]-self.pad] == 0
+
+        boxes = dict()
+        for goal, dist_map in self.fields.items():
+            if self.free[pos]:
+                changed = self.repair(dist_map, [], [pos])
+            else:
+                changed = self.repair(dist_map, [pos], [])
+
+            if changed:
+                changed = np.array(changed)
+                boxes[goal] = (changed[:, 0].min(), changed[:, 0].max(), changed[:, 1].min(), changed[:, 1].max())
+
+        return boxes
+
+    def repair(self, dist_map:np.ndarray, blocked:list, opened:list):
+        '''
+        incremental shortest path repair of one padded field, cost scales with the changed region
+        1. raise: cells that lost every neighbour one step closer to goal become unreachable,
+           visited in order of old distance so each cell's support is already final
+        2. lower: re-propagate from the boundary of raised region and opened cells
+        '''
+        inf = np.iinfo(dist_map.dtype).max
+        changed = list()
+
+        heap = []
+        for pos in blocked:
+            if dist_map[pos] != inf:
+                heap.append((int(dist_map[pos]), pos))
+            dist_map[pos] = inf
+            changed.append(pos)
+        heapq.heapify(heap)
+
+        raised = []
+        while heap:
+            dist, (x, y) = heapq.heappop(heap)
+            for next_pos in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+                if self.free[next_pos] and dist_map[next_pos] == dist+1:
+                    i, j = next_pos
+                    if all(dist_map[support] != dist for support in ((i-1, j), (i+1, j), (i, j-1), (i, j+1))):
+                        dist_map[next_pos] = inf
+                        raised.append(next_pos)
+                        heapq.heappush(heap, (dist+1, next_pos))
+
+        for x, y in raised + opened:
+            dist = min([ int(dist_map[next_pos]) for next_pos in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)) if self.free[next_pos] ], default=inf)
+            if dist < inf and dist+1 < dist_map[x, y]:
+                dist_map[x, y] = dist+1
+                heapq.heappush(heap, (dist+1, (x, y)))
+            changed.append((x, y))
+
+        while heap:
+            dist, (x, y) = heapq.heappop(heap)
+            if dist > dist_map[x, y]:
+                continue
+            for next_pos in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+                if self.free[next_pos] and dist_map[next_pos] > dist+1:
+                    dist_map[next_pos] = dist+1
+                    heapq.heappush(heap, (dist+1, next_pos))
+                    changed.append(next_pos)
+
+        return changed
+
 
 
 class Environment:
     def __init__(self, adaptive=False, fix_density=None, map_length:int=config.map_length, num_agents:int=config.num_agents,
-                obs_radius:int=config.obs_radius, reward_fn:dict=config.reward_fn):
+                obs_radius:int=config.obs_radius, reward_fn:dict=config.reward_fn, navi_backend:str=config.navi_backend,
+                lifelong:bool=config.lifelong):
         '''
         self.map_length:
             x                   fixed map size (x, x)
@@ -87,7 +252,19 @@ class Environment:
             x                   fixed number of agents x
             (x, y)              randomly choose one from range x to y every time reset environment
             [x1, x2, ... xn]    randomly choose one from x1 to xn every time reset environment
+
+        self.navi_backend:
+            dense               materialize navigation channels of all agents on the whole map
+            compact             keep one distance field per goal, derive channels in observation window
+
+        self.lifelong:
+            agent that reaches its goal gets a new one in the same partition, episode never finishes
         '''
+        assert navi_backend in ('dense', 'compact'), 'navigation backend does not support'
+        self.navi_backend = navi_backend
+        self.lifelong = lifelong
+        self.goals_reached = 0
+        self.trajectory = None
         self.adaptive = adaptive
         if adaptive:
             self.num_agents = config.init_set[0]
@@ -114,6 +291,9 @@ class Environment:
             self.map = np.random.choice(2, self.map_size, p=[1-self.obstacle_density, self.obstacle_density]).astype(np.int)
             partition_list = map_partition(self.map)
             partition_list = [ partition for partition in partition_list if len(partition) >= 2 ]
+
+        if self.lifelong:
+            self.set_partitions(partition_list)
         
         self.agents_pos = np.empty((self.num_agents, 2), dtype=np.int)
         self.goals_pos = np.empty((self.num_agents, 2), dtype=np.int)
@@ -172,6 +352,9 @@ class Environment:
             self.map = np.random.choice(2, self.map_size, p=[1-self.obstacle_density, self.obstacle_density]).astype(np.float32)
             partition_list = map_partition(self.map)
             partition_list = [ partition for partition in partition_list if len(partition) >= 2 ]
+
+        if self.lifelong:
+            self.set_partitions(partition_list)
         
         self.agents_pos = np.empty((self.num_agents, 2), dtype=np.int)
         self.goals_pos = np.empty((self.num_agents, 2), dtype=np.int)
@@ -201,7 +384,12 @@ class Environment:
             pos_num = sum([ len(partition) for partition in partition_list ])
 
         self.steps = 0
+        self.goals_reached = 0
         self.get_navi_map()
+
+        if self.trajectory is not None:
+            self.start_record()
+
         return self.observe()
 
     def load(self, map:np.ndarray, agents_pos:np.ndarray, goals_pos:np.ndarray):
@@ -215,74 +403,160 @@ class Environment:
         self.map_size = (self.map.shape[0], self.map.shape[1])
 
         # self.history = [np.copy(self.agents_pos)]
+
+        if self.lifelong:
+            self.set_partitions(map_partition(self.map))
         
         self.steps = 0
+        self.goals_reached = 0
 
-        # self.fig = plt.figure()
-        self.imgs = []
+        if self.trajectory is not None:
+            self.start_record()
 
         self.get_navi_map()
 
     def get_navi_map(self):
-        dist_map = np.ones((self.num_agents, *self.map_size), dtype=np.int32)*2147483647
-        for i in range(self.num_agents):
-            open_list = list()
-            x, y = tuple(self.goals_pos[i])
-            open_list.append((x, y))
-            dist_map[i, x, y] = 0
-
-            while open_list:
-                x, y = open_list.pop(0)
-                dist = dist_map[i, x, y]
-
-                up = x-1, y
-                if up[0] >= 0 and self.map[up]==0 and dist_map[i, x-1, y] > dist+1:
-                    dist_map[i, x-1, y] = dist+1
-                    if up not in open_list:
-                        open_list.append(up)
-                
-                down = x+1, y
-                if down[0] < self.map_size[0] and self.map[down]==0 and dist_map[i, x+1, y] > dist+1:
-                    dist_map[i, x+1, y] = dist+1
-                    if down not in open_list:
-                        open_list.append(down)
-                
-                left = x, y-1
-                if left[1] >= 0 and self.map[left]==0 and dist_map[i, x, y-1] > dist+1:
-                    dist_map[i, x, y-1] = dist+1
-                    if left not in open_list:
-                        open_list.append(left)
-                
-                right = x, y+1
-                if right[1] < self.map_size[1] and self.map[right]==0 and dist_map[i, x, y+1] > dist+1:
-                    dist_map[i, x, y+1] = dist+1
-                    if right not in open_list:
-                        open_list.append(right)
-        
-        self.navi_map = np.zeros((self.num_agents, 4, *self.map_size), dtype=np.bool)
-
-        for x in range(self.map_size[0]):
-            for y in range(self.map_size[1]):
-                if self.map[x, y] == 0:
-                    for i in range(self.num_agents):
-
-                        if x > 0 and dist_map[i, x-1, y] < dist_map[i, x, y]:
-                            assert dist_map[i, x-1, y] == dist_map[i, x, y]-1
-                            self.navi_map[i, 0, x, y] = 1
-                        
-                        if x < self.map_size[0]-1 and dist_map[i, x+1, y] < dist_map[i, x, y]:
-                            assert dist_map[i, x+1, y] == dist_map[i, x, y]-1
-                            self.navi_map[i, 1, x, y] = 1
-
-                        if y > 0 and dist_map[i, x, y-1] < dist_map[i, x, y]:
-                            assert dist_map[i, x, y-1] == dist_map[i, x, y]-1
-                            self.navi_map[i, 2, x, y] = 1
-                        
-                        if y < self.map_size[1]-1 and dist_map[i, x, y+1] < dist_map[i, x, y]:
-                            assert dist_map[i, x, y+1] == dist_map[i, x, y]-1
-                            self.navi_map[i, 3, x, y] = 1
-
-        self.navi_map = np.pad(self.navi_map, ((0, 0), (0, 0), (self.obs_radius, self.obs_radius), (self.obs_radius, self.obs_radius)))
+        self.dist_fields = DistanceFields(self.map, self.goals_pos, self.obs_radius)
+
+        if self.navi_backend == 'dense':
+            self.navi_map = self.dist_fields.navi_map()
+
+    def set_partitions(self, partition_list:list):
+        '''label each free cell with its partition, used to draw new goals in lifelong mode'''
+        self.partition_map = np.full(self.map_size, -1, dtype=np.int32)
+        self.partition_cells = []
+        for partition_idx, partition in enumerate(partition_list):
+            cells = np.array(partition, dtype=np.int)
+            self.partition_map[cells[:, 0], cells[:, 1]] = partition_idx
+            self.partition_cells.append(cells)
+
+    def assign_goal(self, agent_id:int):
+        '''
+        give agent a new goal in its partition that is neither its position nor another agent's goal,
+        only this agent's distance field and navigation channels are recomputed
+        '''
+        cells = self.partition_cells[self.partition_map[tuple(self.agents_pos[agent_id])]]
+
+        occupied = np.zeros(self.map_size, dtype=np.bool)
+        occupied[self.goals_pos[:, 0], self.goals_pos[:, 1]] = True
+        occupied[tuple(self.agents_pos[agent_id])] = True
+        cells = cells[~occupied[cells[:, 0], cells[:, 1]]]
+
+        if cells.shape[0] == 0:
+            # whole partition is taken, keep current goal
+            return
+
+        self.goals_pos[agent_id] = cells[random.randint(0, cells.shape[0]-1)]
+        self.dist_fields.set_goal(agent_id, self.goals_pos[agent_id])
+
+        if self.navi_backend == 'dense':
+            self.navi_map[agent_id] = self.dist_fields.agent_navi_map(agent_id)
+
+    def toggle_cells(self, cells:np.ndarray):
+        '''
+        switch cells between empty and obstacle during an episode, only the changed part of each
+        distance field and of dense navigation channels is recomputed
+        '''
+        for pos in cells:
+            pos = (int(pos[0]), int(pos[1]))
+            if self.map[pos] == 0:
+                if np.any(np.all(self.agents_pos==pos, axis=1)) or np.any(np.all(self.goals_pos==pos, axis=1)):
+                    raise RuntimeError('cannot place obstacle on agent or goal at {}'.format(pos))
+                self.map[pos] = 1
+            else:
+                self.map[pos] = 0
+
+            boxes = self.dist_fields.update_cell(pos)
+
+            if self.navi_backend == 'dense':
+                free = self.dist_fields.free
+                for agent_id, goal in enumerate(self.dist_fields.agent_goals):
+                    if goal not in boxes:
+                        continue
+                    # channels of changed cells and their neighbours, navi_map is padded one cell less than fields
+                    x0, x1, y0, y1 = boxes[goal]
+                    x0, y0 = max(x0-1, 1), max(y0-1, 1)
+                    x1, y1 = min(x1+1, free.shape[0]-2), min(y1+1, free.shape[1]-2)
+                    dist_map = self.dist_fields.fields[goal]
+                    self.navi_map[agent_id, :, x0-1:x1, y0-1:y1] = navi_channels(dist_map[x0-1:x1+2, y0-1:y1+2], free[x0:x1+1, y0:y1+1])
+
+            if self.lifelong:
+                self.update_partitions(pos)
+
+    def update_partitions(self, pos:tuple):
+        '''
+        keep partitions of lifelong mode after map[pos] is toggled, an opened cell joins or merges the
+        partitions around it, a blocked cell only splits its partition if its free neighbours are not
+        connected through the 8 cells around it, then only that partition is labelled again
+        '''
+        x, y = pos
+        in_map = lambda i, j: 0 <= i < self.map_size[0] and 0 <= j < self.map_size[1]
+        neighbours = [ (i, j) for i, j in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)) if in_map(i, j) and self.map[i, j] == 0 ]
+
+        if self.map[pos] == 0:
+            labels = { int(self.partition_map[n]) for n in neighbours } - {-1}
+            # free cells without a partition are single cell partitions left out at reset
+            cells = [np.array([pos])] + [ np.array([n]) for n in neighbours if self.partition_map[n] == -1 ]
+            label = max(labels, key=lambda l: len(self.partition_cells[l])) if labels else self.new_partition()
+            for l in labels:
+                cells.append(self.partition_cells[l])
+                self.partition_cells[l] = np.empty((0, 2), dtype=np.int)
+            cells = np.concatenate(cells)
+            self.partition_map[cells[:, 0], cells[:, 1]] = label
+            self.partition_cells[label] = cells
+            return
+
+        label = int(self.partition_map[pos])
+        self.partition_map[pos] = -1
+        if label == -1:
+            return
+        cells = self.partition_cells[label]
+        self.partition_cells[label] = cells[(cells[:, 0] != x) | (cells[:, 1] != y)]
+
+        # neighbours in one run of free cells around pos stay connected
+        ring = ((x-1, y-1), (x-1, y), (x-1, y+1), (x, y+1), (x+1, y+1), (x+1, y), (x+1, y-1), (x, y-1))
+        ring_free = [ in_map(i, j) and self.map[i, j] == 0 for i, j in ring ]
+        if all(ring_free):
+            return
+        first = ring_free.index(False)
+        runs = 0
+        in_run = False
+        for k in range(first, first+8):
+            if not ring_free[k%8]:
+                in_run = False
+            elif k%2 == 1 and not in_run:
+                # run reaches an orthogonal neighbour, which are at odd ring indices
+                runs += 1
+                in_run = True
+        if runs <= 1:
+            return
+
+        remaining = self.partition_map == label
+        components = []
+        for start in neighbours:
+            if remaining[start]:
+                component = bfs_distance(~remaining, start) < np.iinfo(np.int32).max
+                remaining &= ~component
+                components.append(component)
+
+        for component in components[1:]:
+            new_label = self.new_partition()
+            self.partition_map[component] = new_label
+            self.partition_cells[new_label] = np.argwhere(component)
+        if len(components) > 1:
+            self.partition_cells[label] = np.argwhere(components[0])
+
+    def new_partition(self):
+        '''label of an emptied partition, or of a new one'''
+        for label, cells in enumerate(self.partition_cells):
+            if cells.shape[0] == 0:
+                return label
+        self.partition_cells.append(np.empty((0, 2), dtype=np.int))
+        return len(self.partition_cells)-1
+
+    def throughput(self):
+        '''goals reached per step in lifelong mode'''
+        return self.goals_reached / max(self.steps, 1)
 
     def step(self, actions: List[int]):
         '''
@@ -421,13 +695,27 @@ class Environment:
         self.steps += 1
 
         # check done
-        if np.array_equal(self.agents_pos, self.goals_pos):
+        if self.lifelong:
+            done = False
+            reached = np.flatnonzero(np.all(self.agents_pos==self.goals_pos, axis=1))
+            for agent_id in reached:
+                rewards[agent_id] = self.reward_fn['finish']
+                self.assign_goal(agent_id)
+            self.goals_reached += reached.shape[0]
+
+        elif np.array_equal(self.agents_pos, self.goals_pos):
             done = True
             rewards = [ self.reward_fn['finish'] for _ in range(self.num_agents) ]
         else:
             done = False
 
         info = {'step': self.steps-1}
+        if self.lifelong:
+            info['goals_reached'] = reached.shape[0]
+
+        if self.trajectory is not None:
+            self.trajectory['agents'].append(self.agents_pos.astype(np.int16))
+            self.trajectory['goals'].append(self.goals_pos.astype(np.int16))
 
         # make sure no overlapping agents
         if np.unique(self.agents_pos, axis=0).shape[0] < self.num_agents:
@@ -471,47 +759,22 @@ class Environment:
 
             obs[i, 1] = obstacle_map[x:x+2*self.obs_radius+1, y:y+2*self.obs_radius+1]
 
-            obs[i, 2:] = self.navi_map[i, :, x:x+2*self.obs_radius+1, y:y+2*self.obs_radius+1]
+            if self.navi_backend == 'dense':
+                obs[i, 2:] = self.navi_map[i, :, x:x+2*self.obs_radius+1, y:y+2*self.obs_radius+1]
+            else:
+                obs[i, 2:] = self.dist_fields.window(i, x, y)
 
         return obs
     
-    def render(self):
-        if not hasattr(self, 'fig'):
-            self.fig = plt.figure()
-
-        map = np.copy(self.map)
-        for agent_id in range(self.num_agents):
-            if np.array_equal(self.agents_pos[agent_id], self.goals_pos[agent_id]):
-                map[tuple(self.agents_pos[agent_id])] = 4
-            else:
-                map[tuple(self.agents_pos[agent_id])] = 2
-                map[tuple(self.goals_pos[agent_id])] = 3
-
-        map = map.astype(np.uint8)
-        # plt.xlabel('step: {}'.format(self.steps))
-
-        # add text in plot
-        self.imgs.append([])
-        if hasattr(self, 'texts'):
-            for i, ((agent_x, agent_y), (goal_x, goal_y)) in enumerate(zip(self.agents_pos, self.goals_pos)):
-                self.texts[i].set_position((agent_y, agent_x))
-                self.texts[i].set_text(i)
-        else:
-            self.texts = []
-            for i, ((agent_x, agent_y), (goal_x, goal_y)) in enumerate(zip(self.agents_pos, self.goals_pos)):
-                text = plt.text(agent_y, agent_x, i, color='black', ha='center', va='center')
-                plt.text(goal_y, goal_x, i, color='black', ha='center', va='center')
-                self.texts.append(text)
-
-
-        plt.imshow(color_map[map], animated=True)
-
-
-        plt.show()
-        # plt.ion()
-        plt.pause(0.5)
-
-    def close(self, save=False):
-
-        plt.close()
-        del self.fig
+    def start_record(self):
+        '''record agent and goal positions every step, cleared on reset and load'''
+        self.trajectory = {'map': self.map.astype(np.uint8), 'agents': [self.agents_pos.astype(np.int16)],
+                            'goals': [self.goals_pos.astype(np.int16)]}
+
+    def stop_record(self):
+        self.trajectory = None
+
+    def get_trajectory(self):
+        '''map (H, W), agents and goals (steps+1, num_agents, 2), render with render.save_gif'''
+        return {'map': self.trajectory['map'], 'agents': np.stack(self.trajectory['agents']),
+                'goals': np.stack(self.trajectory['goals'])}
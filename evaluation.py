@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+import torch
+
+import config
+from environment import Environment
+from model import Network
+
+
+def evaluate(network:Network, tests:dict, device=torch.device('cpu'), max_steps:int=config.max_steps):
+    '''
+    greedy rollouts over all cases of a test dict, return success rate, mean steps and
+    mean latency of one Network.step call in ms
+    '''
+    env = Environment()
+    success = 0
+    steps = []
+    step_time = 0
+    step_calls = 0
+
+    for map, agents_pos, goals_pos in zip(tests['maps'], tests['agents'], tests['goals']):
+        env.load(map, agents_pos, goals_pos)
+        network.reset()
+
+        done = False
+        obs = env.observe()
+        while not done and env.steps < max_steps:
+            start = time.perf_counter()
+            actions, _, _ = network.step(torch.from_numpy(obs.astype(np.float32)).to(device))
+            step_time += time.perf_counter()-start
+            step_calls += 1
+
+            obs, _, done, _ = env.step(actions)
+
+        steps.append(env.steps)
+        if np.array_equal(env.agents_pos, env.goals_pos):
+            success += 1
+
+    return {'success_rate': success/len(steps), 'mean_steps': sum(steps)/len(steps), 'latency': 1000*step_time/step_calls}
+
+
+def evaluate_batched(network:Network, tests:dict, device=torch.device('cpu'), max_steps:int=config.max_steps, num_envs:int=config.eval_batch_envs):
+    '''
+    same greedy rollouts as evaluate, num_envs cases at a time with agents of all running cases
+    stacked in one Network.step_hidden call
+    '''
+    num_cases = len(tests['maps'])
+    success = 0
+    steps = []
+
+    for begin in range(0, num_cases, num_envs):
+        envs = []
+        for i in range(begin, min(begin+num_envs, num_cases)):
+            env = Environment()
+            env.load(tests['maps'][i], tests['agents'][i], tests['goals'][i])
+            envs.append(env)
+
+        obs = [ env.observe() for env in envs ]
+        running = list(range(len(envs)))
+        hidden = None
+
+        while running:
+            batch = np.concatenate([ obs[i] for i in running ])
+            actions, _, hidden = network.step_hidden(torch.from_numpy(batch.astype(np.float32)).to(device), hidden)
+
+            # rows of hidden state of cases still running
+            keep = []
+            still_running = []
+            offset = 0
+            for i in running:
+                num_agents = obs[i].shape[0]
+                obs[i], _, done, _ = envs[i].step(actions[offset:offset+num_agents])
+                if not done and envs[i].steps < max_steps:
+                    keep.extend(range(offset, offset+num_agents))
+                    still_running.append(i)
+                offset += num_agents
+
+            running = still_running
+            if running and len(keep) < offset:
+                hidden = hidden[:, torch.tensor(keep, device=hidden.device)]
+
+        for env in envs:
+            steps.append(env.steps)
+            if np.array_equal(env.agents_pos, env.goals_pos):
+                success += 1
+
+    return {'success_rate': success/len(steps), 'mean_steps': sum(steps)/len(steps)}
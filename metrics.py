@@ -0,0 +1,199 @@
+import time
+import os
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict
+
+import config
+
+# histogram upper bounds in seconds
+time_buckets = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# gauges of each role derived from its summed counters, name: (numerator, denominator)
+counter_ratios = {
+    'encoder_cache_hit_rate': ('encoder_cache_hits', 'encoder_cache_lookups'),
+}
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    def __init__(self, buckets=time_buckets):
+        self.buckets = buckets
+        # last one is +Inf bucket
+        self.counts = [ 0 for _ in range(len(buckets)+1) ]
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        assert self.buckets == other.buckets
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q:float):
+        '''upper bound of the bucket that contains quantile q'''
+        target = q*self.count
+        cum = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cum += count
+            if cum >= target:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    def __init__(self, role:str):
+        '''
+        Stage timers, gauges and counters of one process, cumulative since start.
+        Snapshots are sent to train.py which merges and exports them, gauges are kept per
+        source and counters are summed over the sources of a role.
+        '''
+        self.role = role
+        self.histograms = dict()
+        self.gauges = dict()
+        self.counters = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, name:str, value:float):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def set(self, name:str, value:float):
+        self.gauges[name] = value
+
+    def count(self, name:str, value:int):
+        '''set cumulative count of this process, only for values that add up over processes'''
+        self.counters[name] = value
+
+    @contextmanager
+    def timer(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter()-start)
+
+    @contextmanager
+    def timed_lock(self, lock:threading.Lock, name:str='lock_wait'):
+        '''acquire lock and record waiting time'''
+        start = time.perf_counter()
+        lock.acquire()
+        self.observe(name, time.perf_counter()-start)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def snapshot(self):
+        with self.lock:
+            histograms = { name: (hist.counts.copy(), hist.sum, hist.count) for name, hist in self.histograms.items() }
+        return {'role': self.role, 'histograms': histograms, 'gauges': self.gauges.copy(), 'counters': self.counters.copy()}
+
+
+class MetricsExporter:
+    def __init__(self, path:str=config.metrics_path, port:int=config.metrics_port):
+        '''merge snapshots by role and write them in prometheus text format'''
+        self.path = path
+        self.snapshots = dict()
+        self.text = ''
+
+        if port is not None:
+            exporter = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = exporter.text.encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = HTTPServer(('', port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def update(self, snapshots:Dict[str, dict]):
+        '''snapshots keyed by source, e.g. actor3, a newer snapshot replaces the older one of same source'''
+        self.snapshots.update(snapshots)
+
+    def merge(self):
+        '''histograms and counters by (role, name), gauges by (role, source, name)'''
+        histograms, gauges, counters = dict(), dict(), dict()
+        for source, snapshot in self.snapshots.items():
+            role = snapshot['role']
+            for name, (counts, total, count) in snapshot['histograms'].items():
+                hist = Histogram()
+                hist.counts, hist.sum, hist.count = list(counts), total, count
+                if (role, name) in histograms:
+                    histograms[(role, name)].merge(hist)
+                else:
+                    histograms[(role, name)] = hist
+
+            # rates and replicated values like updates of each learner rank do not add up
+            for name, value in snapshot['gauges'].items():
+                gauges[(role, source, name)] = value
+
+            for name, value in snapshot['counters'].items():
+                counters[(role, name)] = counters.get((role, name), 0) + value
+
+        for (role, name), value in list(counters.items()):
+            for ratio, (numerator, denominator) in counter_ratios.items():
+                if name == denominator and value > 0:
+                    gauges[(role, 'all', ratio)] = counters.get((role, numerator), 0) / value
+
+        return histograms, gauges, counters
+
+    def export(self):
+        histograms, gauges, counters = self.merge()
+
+        lines = ['# TYPE mapf_stage_seconds histogram']
+        for (role, name), hist in sorted(histograms.items()):
+            label = 'role="{}",stage="{}"'.format(role, name)
+            cum = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cum += count
+                lines.append('mapf_stage_seconds_bucket{{{},le="{}"}} {}'.format(label, bound, cum))
+            lines.append('mapf_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(label, hist.count))
+            lines.append('mapf_stage_seconds_sum{{{}}} {}'.format(label, hist.sum))
+            lines.append('mapf_stage_seconds_count{{{}}} {}'.format(label, hist.count))
+
+        lines.append('# TYPE mapf_gauge gauge')
+        for (role, source, name), value in sorted(gauges.items()):
+            lines.append('mapf_gauge{{role="{}",source="{}",name="{}"}} {}'.format(role, source, name, value))
+
+        lines.append('# TYPE mapf_counter counter')
+        for (role, name), value in sorted(counters.items()):
+            lines.append('mapf_counter_total{{role="{}",name="{}"}} {}'.format(role, name, value))
+
+        self.text = '\n'.join(lines) + '\n'
+
+        if self.path is not None:
+            with open(self.path+'.tmp', 'w') as f:
+                f.write(self.text)
+            os.replace(self.path+'.tmp', self.path)
+
+        return histograms, gauges, counters
+
+    def summary(self):
+        histograms, gauges, counters = self.export()
+        for (role, name), hist in sorted(histograms.items()):
+            if hist.count:
+                print('{} {}: {} calls, mean {:.3f} ms, p95 < {} ms'.format(role, name, hist.count,
+                        1000*hist.sum/hist.count, 1000*hist.quantile(0.95)))
+        for (role, source, name), value in sorted(gauges.items()):
+            print('{} {}: {}'.format(role if source == 'all' else source, name, value))
+        for (role, name), value in sorted(counters.items()):
+            print('{} {}: {}'.format(role, name, value))
@@ -1,3 +1,6 @@
+import threading
+from collections import OrderedDict
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -21,6 +24,17 @@ class ResBlock(nn.Module):
                 self.block1 = nn.Conv2d(channel, channel, a, b, c)
                 self.block2 = nn.Conv2d(channel, channel, a, b, c)
 
+        elif type == 'dwcnn':
+            # depthwise separable convolution
+            self.block1 = nn.Sequential(
+                nn.Conv2d(channel, channel, a, b, c, groups=channel),
+                nn.Conv2d(channel, channel, 1, 1)
+            )
+            self.block2 = nn.Sequential(
+                nn.Conv2d(channel, channel, a, b, c, groups=channel),
+                nn.Conv2d(channel, channel, 1, 1)
+            )
+
         elif type == 'linear':
             self.block1 = nn.Linear(channel, channel)
             self.block2 = nn.Linear(channel, channel)
@@ -41,27 +55,83 @@ class ResBlock(nn.Module):
 
         return x
 
+class EncoderCache:
+    def __init__(self, size:int):
+        '''
+        LRU of encoder outputs keyed by the packed bits of an observation, for agents whose
+        observation repeats, e.g. waiting on goal. Entries are dropped when weights change
+        '''
+        self.size = size
+        self.entries = OrderedDict()
+        self.version = None
+        self.lookups = 0
+        self.hits = 0
+        # actors with environment groups also bootstrap on another thread
+        self.lock = threading.Lock()
+
+    def encode(self, encoder:nn.Module, obs:torch.Tensor, version:int):
+        keys = [ row.tobytes() for row in np.packbits(obs.cpu().numpy().reshape(obs.size(0), -1) > 0, axis=1) ]
+
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+            latent = [ None for _ in keys ]
+            # rows of each missing observation
+            misses = dict()
+            for i, key in enumerate(keys):
+                cached = self.entries.get(key)
+                if cached is None:
+                    misses.setdefault(key, []).append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    latent[i] = cached
+
+            self.lookups += len(keys)
+            self.hits += len(keys) - sum(len(rows) for rows in misses.values())
+
+        if misses:
+            # forward outside of lock so the other thread can look up meanwhile
+            encoded = encoder(obs[[ rows[0] for rows in misses.values() ]])
+            for rows, value in zip(misses.values(), encoded):
+                for i in rows:
+                    latent[i] = value
+
+            with self.lock:
+                # entries of older weights are not kept
+                if version == self.version:
+                    # own storage instead of a view that keeps the whole batch alive
+                    for key, value in zip(misses.keys(), encoded):
+                        self.entries[key] = value.clone()
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+
+        return torch.stack(latent)
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+
 class Network(nn.Module):
-    def __init__(self, cnn_channel=config.cnn_channel):
+    def __init__(self, cnn_channel=config.cnn_channel, num_blocks=3, latent_dim=config.latent_dim, depthwise=False):
 
         super().__init__()
 
+        # saved with checkpoints so smaller networks can be rebuilt by load_network
+        self.arch = dict(cnn_channel=cnn_channel, num_blocks=num_blocks, latent_dim=latent_dim, depthwise=depthwise)
+
         self.obs_dim = config.obs_shape[0]
-        self.latent_dim = config.latent_dim
+        self.latent_dim = latent_dim
         self.output_shape = (64, 5, 5)
 
         self.obs_encoder = nn.Sequential(
-            nn.Conv2d(self.obs_dim, 128, 3, 1),
+            nn.Conv2d(self.obs_dim, cnn_channel, 3, 1),
             nn.ReLU(True),
 
-            ResBlock(128, type='cnn'),
-
-            ResBlock(128, type='cnn'),
-
-            ResBlock(128, type='cnn'),
+            *[ ResBlock(cnn_channel, type='dwcnn' if depthwise else 'cnn') for _ in range(num_blocks) ],
 
-
-            nn.Conv2d(128, 8, 1, 1),
+            nn.Conv2d(cnn_channel, 8, 1, 1),
             nn.ReLU(True),
 
             nn.Flatten(),
@@ -75,6 +145,9 @@ class Network(nn.Module):
         self.state = nn.Linear(self.latent_dim, 1)
 
         self.hidden = None
+        # optional encoder output cache of step, bumped weights version invalidates it
+        self.encoder_cache = None
+        self.weights_version = 0
 
         for _, m in self.named_modules():
             if isinstance(m, nn.Linear) or isinstance(m, nn.Conv2d):
@@ -82,52 +155,108 @@ class Network(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
+    def enable_encoder_cache(self, size:int):
+        self.encoder_cache = EncoderCache(size)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.weights_version += 1
+        return super().load_state_dict(*args, **kwargs)
+
     @torch.no_grad()
     def step(self, obs):
         # print(obs.shape)
-        latent = self.obs_encoder(obs)
+        actions, q_val, self.hidden = self.step_hidden(obs, self.hidden)
+
+        return actions, q_val, self.hidden[0].cpu().numpy()
+
+    @torch.no_grad()
+    def step_hidden(self, obs, hidden=None):
+        '''step with recurrent state passed in and returned, for actors that interleave environments'''
+        if self.encoder_cache is not None:
+            latent = self.encoder_cache.encode(self.obs_encoder, obs, self.weights_version)
+        else:
+            latent = self.obs_encoder(obs)
         latent = latent.unsqueeze(1)
 
         self.recurrent.flatten_parameters()
-        if self.hidden is None:
-            _, self.hidden = self.recurrent(latent)
+        if hidden is None:
+            _, hidden = self.recurrent(latent)
         else:
-            _, self.hidden = self.recurrent(latent, self.hidden)
+            _, hidden = self.recurrent(latent, hidden)
 
-        hidden = torch.squeeze(self.hidden[0], dim=0)
-        adv_val = self.adv(hidden)
-        state_val = self.state(hidden)
+        adv_val = self.adv(hidden[0])
+        state_val = self.state(hidden[0])
 
         q_val = state_val + adv_val - adv_val.mean(1, keepdim=True)
         # print(q_val.shape)
         actions = torch.argmax(q_val, 1).tolist()
 
-        return actions, q_val.cpu().numpy(), self.hidden[0].cpu().numpy()
+        return actions, q_val.cpu().numpy(), hidden
 
     def reset(self):
         self.hidden = None
 
+    def forward(self, obs, hidden=None):
+        '''q values of every step of (batch, steps, *obs_shape) sequences'''
+        batch_size, step = obs.size(0), obs.size(1)
+
+        latent = self.obs_encoder(obs.contiguous().view(-1, *config.obs_shape))
+        latent = latent.view(batch_size, step, -1)
+
+        self.recurrent.flatten_parameters()
+        hiddens, hidden = self.recurrent(latent, hidden)
+
+        adv_val = self.adv(hiddens)
+        state_val = self.state(hiddens)
+
+        q_val = state_val + adv_val - adv_val.mean(2, keepdim=True)
+
+        return q_val, hidden
+
     def bootstrap(self, obs, steps, hidden):
         batch_size = obs.size(0)
-        step = obs.size(1)
-        hidden = (hidden[0].unsqueeze(0), hidden[1].unsqueeze(0))
-
-        obs = obs.contiguous().view(-1, self.obs_dim, 9, 9)
+        hidden = hidden.unsqueeze(0)
 
-        latent = self.obs_encoder(obs)
+        # only encode valid frames and scatter them into the padded sequence
+        steps = torch.as_tensor(steps, dtype=torch.long)
+        step = steps.max().item()
+        mask = torch.arange(step).unsqueeze(0) < steps.unsqueeze(1)
+        mask = mask.to(obs.device)
 
-        latent = latent.view(batch_size, step, 8*7*7)
+        latent = self.obs_encoder(obs[:, :step][mask])
+        latent = latent.new_zeros(batch_size, step, latent.size(1)).masked_scatter_(mask.unsqueeze(2), latent)
 
-        latent = pack_padded_sequence(latent, steps, batch_first=True, enforce_sorted=False)
+        # batches from GlobalBuffer are sorted by length, so packing can skip sorting
+        enforce_sorted = torch.all(steps[:-1] >= steps[1:]).item()
+        latent = pack_padded_sequence(latent, steps, batch_first=True, enforce_sorted=enforce_sorted)
 
         self.recurrent.flatten_parameters()
         _, hidden = self.recurrent(latent, hidden)
 
-        hidden = torch.squeeze(hidden[0])
-        
+        hidden = hidden[0]
+
         adv_val = self.adv(hidden)
         state_val = self.state(hidden)
 
         q_val = state_val + adv_val - adv_val.mean(1, keepdim=True)
 
-        return q_val
\ No newline at end of file
+        return q_val
+
+def load_network(path:str, device=torch.device('cpu')):
+    '''load model saved as plain state dict, learner checkpoint or dict with arch and state_dict'''
+    checkpoint = torch.load(path, map_location=device, mmap=True, weights_only=False)
+
+    if 'arch' in checkpoint:
+        network = Network(**checkpoint['arch'])
+        # full learner checkpoints keep weights under model
+        network.load_state_dict(checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint['model'])
+    elif 'model' in checkpoint:
+        network = Network()
+        network.load_state_dict(checkpoint['model'])
+    else:
+        network = Network()
+        network.load_state_dict(checkpoint)
+
+    network.to(device)
+    network.eval()
+    return network
@@ -0,0 +1,95 @@
+'''
+Offline rendering of trajectories recorded by Environment.start_record, only needs numpy
+
+    env.start_record()
+    ...
+    save_gif(env.get_trajectory(), 'episode.gif')
+'''
+import os
+import struct
+
+import numpy as np
+
+from environment import color_map
+
+
+def trajectory_frames(trajectory:dict):
+    '''
+    frame of color_map indices for each step
+        0 empty, 1 obstacle, 2 agent, 3 goal, 4 agent on its goal
+    '''
+    agents, goals = trajectory['agents'].astype(np.int64), trajectory['goals'].astype(np.int64)
+    num_frames = agents.shape[0]
+    frames = np.repeat(trajectory['map'][None].astype(np.uint8), num_frames, axis=0)
+    steps = np.repeat(np.arange(num_frames), agents.shape[1])
+
+    on_goal = np.all(agents==goals, axis=2).reshape(-1)
+    agents, goals = agents.reshape(-1, 2), goals.reshape(-1, 2)
+
+    frames[steps[~on_goal], goals[~on_goal, 0], goals[~on_goal, 1]] = 3
+    frames[steps, agents[:, 0], agents[:, 1]] = np.where(on_goal, 4, 2)
+
+    return frames
+
+
+def upscale(frames:np.ndarray, scale:int):
+    '''nearest neighbour upscaling of (steps, H, W) frames'''
+    return np.repeat(np.repeat(frames, scale, axis=1), scale, axis=2)
+
+
+def save_ppm(trajectory:dict, directory:str, scale:int=16):
+    '''write one binary ppm image per step'''
+    os.makedirs(directory, exist_ok=True)
+    frames = color_map.astype(np.uint8)[upscale(trajectory_frames(trajectory), scale)]
+    for i, frame in enumerate(frames):
+        with open(os.path.join(directory, '{:04d}.ppm'.format(i)), 'wb') as f:
+            f.write('P6 {} {} 255\n'.format(frame.shape[1], frame.shape[0]).encode())
+            f.write(frame.tobytes())
+
+
+def lzw_encode(indices:np.ndarray):
+    '''
+    encode color indices (< 8) as GIF LZW stream without building a dictionary: a clear code before every
+    6 pixels keeps the code size at 4 bits, which lets the stream be packed with array operations
+    '''
+    clear_code, end_code = 8, 9
+    indices = indices.reshape(-1)
+    pad = -indices.shape[0] % 6
+
+    codes = np.concatenate((indices, np.zeros(pad, dtype=np.uint8))).reshape(-1, 6)
+    codes = np.concatenate((np.full((codes.shape[0], 1), clear_code, dtype=np.uint8), codes), axis=1).reshape(-1)
+    codes = np.concatenate((codes[:codes.shape[0]-pad], [end_code])).astype(np.uint8)
+
+    if codes.shape[0] % 2:
+        codes = np.concatenate((codes, [0])).astype(np.uint8)
+
+    # 4 bit codes, least significant first
+    data = (codes[0::2] | (codes[1::2] << 4)).tobytes()
+
+    blocks = [ bytes([len(data[i:i+255])]) + data[i:i+255] for i in range(0, len(data), 255) ]
+    return b''.join(blocks) + b'\x00'
+
+
+def save_gif(trajectory:dict, path:str, scale:int=16, duration:float=0.5):
+    '''write trajectory as looping gif, duration is seconds per step'''
+    frames = upscale(trajectory_frames(trajectory), scale)
+    height, width = frames.shape[1:]
+
+    palette = np.zeros((8, 3), dtype=np.uint8)
+    palette[:color_map.shape[0]] = color_map
+
+    with open(path, 'wb') as f:
+        f.write(b'GIF89a')
+        # global color table of 8 colors
+        f.write(struct.pack('<HHBBB', width, height, 0xf2, 0, 0))
+        f.write(palette.tobytes())
+        # loop forever
+        f.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+        for frame in frames:
+            f.write(struct.pack('<BBBBHBB', 0x21, 0xf9, 4, 0, int(duration*100), 0, 0))
+            f.write(struct.pack('<BHHHHB', 0x2c, 0, 0, width, height, 0))
+            f.write(b'\x03')
+            f.write(lzw_encode(frame))
+
+        f.write(b'\x3b')
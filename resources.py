@@ -0,0 +1,119 @@
+'''
+CPU plan of training processes on this machine, from the cores this process may run on and the NUMA nodes
+
+    learner     first cores of the first NUMA node, torch threads = its cores (2 cores with a GPU)
+    buffer      next core, then one core per batch sampler and one for the evaluator
+    actors      one core each on the remaining cores, one torch thread
+
+num_actors = None in config uses one actor per remaining core.
+'''
+import glob
+import os
+from typing import List
+
+import torch
+
+import config
+
+
+def parse_cpulist(cpulist:str):
+    '''"0-3,8,10-11" to [0, 1, 2, 3, 8, 10, 11]'''
+    cores = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cores.extend(range(int(start), int(end)+1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0))
+
+
+def numa_nodes(cores:List[int]):
+    '''available cores grouped by NUMA node, one group if the topology is unknown'''
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'), key=lambda p: int(p.split('/')[-2][4:])):
+        with open(path) as f:
+            node = [ core for core in parse_cpulist(f.read()) if core in cores ]
+        if node:
+            nodes.append(node)
+
+    if sum(len(node) for node in nodes) != len(cores):
+        return [cores]
+    return nodes
+
+
+def plan(num_learners:int=None, num_samplers:int=None, num_actors:int=None, gpu:bool=None):
+    '''
+    cores and torch threads of each process, {'learners': [(cores, threads)], 'buffer': (cores, threads),
+    'samplers': [...], 'actors': [...]}, processes share cores round robin if there are not enough
+    '''
+    num_learners = config.num_learners if num_learners is None else num_learners
+    num_samplers = config.num_samplers if num_samplers is None else num_samplers
+    num_actors = config.num_actors if num_actors is None else num_actors
+    if gpu is None:
+        gpu = torch.cuda.is_available() and num_learners == 1
+
+    cores = available_cores()
+    nodes = numa_nodes(cores)
+    # node by node, so that consecutive cores stay within a node
+    ordered = [ core for node in nodes for core in node ]
+
+    if config.learner_threads is not None:
+        learner_cores = config.learner_threads
+    elif gpu:
+        learner_cores = 2
+    else:
+        # a quarter of the machine, within the first node
+        learner_cores = max(1, min(len(nodes[0]), len(cores)//4) // num_learners)
+
+    ptr = 0
+    def take(num:int):
+        nonlocal ptr
+        taken = [ ordered[(ptr+i) % len(ordered)] for i in range(num) ]
+        ptr += num
+        return sorted(set(taken))
+
+    learners = [ (take(learner_cores), learner_cores) for _ in range(num_learners) ]
+    buffer = (take(1), 1)
+    samplers = [ (take(1), 1) for _ in range(num_samplers) ]
+    evaluator = (take(1), 1) if config.eval_interval is not None else None
+
+    remaining = len(ordered)-ptr
+    if num_actors is None:
+        num_actors = max(1, remaining)
+    if remaining <= 0:
+        # machine is oversubscribed, actors share all cores
+        ptr = 0
+    actors = [ (take(1), 1) for _ in range(num_actors) ]
+
+    return {'learners': learners, 'buffer': buffer, 'samplers': samplers, 'evaluator': evaluator, 'actors': actors}
+
+
+def apply(cores:List[int], threads:int):
+    '''pin every thread of this process to cores and set torch intra-op threads'''
+    if config.pin_cpus:
+        for tid in os.listdir('/proc/self/task'):
+            try:
+                os.sched_setaffinity(int(tid), cores)
+            except OSError:
+                # thread exited
+                pass
+    torch.set_num_threads(threads)
+
+
+def summary(resources:dict):
+    print('cpu plan: {} cores, {} numa nodes'.format(len(available_cores()), len(numa_nodes(available_cores()))))
+    for i, (cores, threads) in enumerate(resources['learners']):
+        print('    learner{}: cores {}, {} threads'.format(i, cores, threads))
+    print('    buffer: cores {}'.format(resources['buffer'][0]))
+    for i, (cores, _) in enumerate(resources['samplers']):
+        print('    sampler{}: cores {}'.format(i, cores))
+    if resources['evaluator'] is not None:
+        print('    evaluator: cores {}'.format(resources['evaluator'][0]))
+    print('    {} actors: cores {}'.format(len(resources['actors']), sorted(set(core for cores, _ in resources['actors'] for core in cores))))
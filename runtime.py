@@ -0,0 +1,247 @@
+'''
+Runtime behind the remote classes of worker.py, selected by config.runtime
+
+    ray     ray actors and object store
+    local   one forked process per remote object on this machine, method calls and results go
+            through torch multiprocessing queues so tensors are passed in shared memory, a call blocks
+            until the remote process has read it
+
+Both expose the ray subset used by this repo:
+
+    @runtime.remote(num_cpus=1)
+    class Worker: ...
+
+    worker = Worker.remote(*args)       # or Worker.options(num_gpus=0).remote(*args)
+    ref = worker.method.remote(*args)
+    runtime.get(ref), runtime.put(obj), runtime.wait(refs, num_returns)
+'''
+import itertools
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import torch.multiprocessing as mp
+
+import config
+
+
+class RemoteClass:
+    def __init__(self, cls, options:dict):
+        self.cls = cls
+        self._options = options
+        self._ray_cls = None
+
+    def options(self, **options):
+        return RemoteClass(self.cls, {**self._options, **options})
+
+    def remote(self, *args, **kwargs):
+        if config.runtime == 'ray':
+            import ray
+            if self._ray_cls is None:
+                self._ray_cls = ray.remote(**self._options)(self.cls)
+            return self._ray_cls.remote(*args, **kwargs)
+        elif config.runtime == 'local':
+            return _local.start(self.cls, self._options.get('max_concurrency', 1), args, kwargs)
+        else:
+            raise RuntimeError('runtime does not support')
+
+
+def remote(**options):
+    '''class decorator, options are ray actor options, only max_concurrency is used by local runtime'''
+    def wrap(cls):
+        return RemoteClass(cls, options)
+    return wrap
+
+
+def init(max_processes:int=64):
+    if config.runtime == 'ray':
+        import ray
+        ray.init()
+    else:
+        _local.init(max_processes)
+
+
+def get(refs):
+    if config.runtime == 'ray':
+        import ray
+        return ray.get(refs)
+    if isinstance(refs, list):
+        return [ ref.get() for ref in refs ]
+    return refs.get()
+
+
+def put(obj):
+    if config.runtime == 'ray':
+        import ray
+        return ray.put(obj)
+    return ObjectRef(obj)
+
+
+def wait(refs:List, num_returns:int=1):
+    '''return (ready, not_ready) refs'''
+    if config.runtime == 'ray':
+        import ray
+        return ray.wait(refs, num_returns=num_returns)
+    return _local.wait(refs, num_returns)
+
+
+class ObjectRef:
+    '''object put by local runtime, sent by value'''
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class CallRef:
+    '''result of a method call in local runtime'''
+    __slots__ = ('call_id', '__weakref__')
+    def __init__(self, call_id:int):
+        self.call_id = call_id
+
+    def get(self):
+        return _local.result(self.call_id)
+
+    def __del__(self):
+        _local.discard(self.call_id)
+
+
+class LocalMethod:
+    __slots__ = ('queue', 'name')
+    def __init__(self, queue, name:str):
+        self.queue = queue
+        self.name = name
+
+    def remote(self, *args, **kwargs):
+        call_id = next(_local.call_ids)
+        self.queue.put((call_id, _local.index, self.name, args, kwargs))
+        return CallRef(call_id)
+
+
+class LocalHandle:
+    def __init__(self, name:str, queue):
+        self.name = name
+        self.queue = queue
+
+    def __getattr__(self, name:str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return LocalMethod(self.queue, name)
+
+
+class LocalRuntime:
+    def __init__(self):
+        self.ctx = None
+        # reply queue of every process, preallocated so that processes forked earlier
+        # can answer processes forked later
+        self.reply_queues = None
+        self.index = 0
+        self.num_processes = 1
+        self.processes = []
+        self.call_ids = itertools.count()
+        self.results = dict()
+        self.discarded = set()
+        self.fetched = set()
+        self.lock = threading.RLock()
+
+    def init(self, max_processes:int):
+        self.ctx = mp.get_context('fork')
+        self.reply_queues = [ self.ctx.SimpleQueue() for _ in range(max_processes) ]
+
+    def start(self, cls, max_concurrency:int, args:tuple, kwargs:dict):
+        assert self.ctx is not None, 'runtime.init() is not called'
+        assert self.index == 0, 'remote objects can only be created by the main process'
+        assert self.num_processes < len(self.reply_queues), 'more than {} processes'.format(len(self.reply_queues))
+
+        queue = self.ctx.SimpleQueue()
+        process = self.ctx.Process(target=self.serve, args=(cls, self.num_processes, max_concurrency, queue, args, kwargs),
+                                daemon=True, name='{}-{}'.format(cls.__name__, self.num_processes))
+        process.start()
+        self.processes.append(process)
+        self.num_processes += 1
+
+        return LocalHandle(cls.__name__, queue)
+
+    def serve(self, cls, index:int, max_concurrency:int, queue, args:tuple, kwargs:dict):
+        '''process main loop, calls are handled in order unless max_concurrency > 1'''
+        self.index = index
+        self.call_ids = itertools.count()
+        self.results = dict()
+        self.discarded = set()
+        self.fetched = set()
+        self.lock = threading.RLock()
+
+        try:
+            instance = cls(*args, **kwargs)
+            error = None
+        except Exception:
+            instance = None
+            error = '{} failed to start in process {}:\n{}'.format(cls.__name__, os.getpid(), traceback.format_exc())
+            print(error)
+        executor = ThreadPoolExecutor(max_concurrency) if max_concurrency > 1 else None
+
+        def handle(call_id, caller, method, args, kwargs):
+            if error is not None:
+                self.reply_queues[caller].put((call_id, False, error))
+                return
+            try:
+                reply = (call_id, True, getattr(instance, method)(*args, **kwargs))
+            except Exception:
+                reply = (call_id, False, '{}.{} failed in process {}:\n{}'.format(cls.__name__, method, os.getpid(), traceback.format_exc()))
+            self.reply_queues[caller].put(reply)
+
+        while True:
+            request = queue.get()
+            if executor is None:
+                handle(*request)
+            else:
+                executor.submit(handle, *request)
+
+    def receive(self):
+        '''move one reply of this process into results, lock must be held'''
+        call_id, success, value = self.reply_queues[self.index].get()
+        if call_id in self.discarded:
+            self.discarded.remove(call_id)
+            if not success:
+                # like ray, errors of results nobody waits for are only printed
+                print('unhandled error: {}'.format(value))
+        else:
+            self.results[call_id] = (success, value)
+
+    def result(self, call_id:int):
+        '''kept until the CallRef is deleted'''
+        with self.lock:
+            while call_id not in self.results:
+                self.receive()
+            success, value = self.results[call_id]
+            self.fetched.add(call_id)
+        if not success:
+            raise RuntimeError(value)
+        return value
+
+    def discard(self, call_id:int):
+        '''result is no longer referenced, drop it now or once it arrives'''
+        with self.lock:
+            if call_id in self.results:
+                success, value = self.results.pop(call_id)
+                if call_id in self.fetched:
+                    self.fetched.remove(call_id)
+                elif not success:
+                    print('unhandled error: {}'.format(value))
+            else:
+                self.discarded.add(call_id)
+
+    def wait(self, refs:List[CallRef], num_returns:int):
+        with self.lock:
+            while sum(ref.call_id in self.results for ref in refs) < num_returns:
+                self.receive()
+            ready = [ ref for ref in refs if ref.call_id in self.results ][:num_returns]
+        not_ready = [ ref for ref in refs if all(ref is not r for r in ready) ]
+        return ready, not_ready
+
+
+_local = LocalRuntime()
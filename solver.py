@@ -0,0 +1,287 @@
+'''
+Reference solvers for test suites, used to annotate test pickles with reference sum of costs and makespan
+
+    pp      prioritized planning with space-time A*, retried with random agent orders
+    cbs     conflict-based search, optimal in sum of costs, bounded-suboptimal with focal search if suboptimality > 1
+
+Conflicts follow Environment.step: two agents cannot be in the same cell at the same time or swap cells,
+following another agent into the cell it leaves is allowed.
+'''
+import time
+import heapq
+import random
+from multiprocessing import Pool
+from typing import List
+
+import numpy as np
+
+import config
+from environment import bfs_distance, action_list
+
+
+class Timeout(Exception):
+    pass
+
+
+class Constraints:
+    __slots__ = ('vertex', 'edge', 'resting', 'goal_last')
+    def __init__(self):
+        # (pos, t): pos is not allowed at time t
+        self.vertex = set()
+        # (pos, next_pos, t): move from pos to next_pos between t and t+1 is not allowed
+        self.edge = set()
+        # pos: pos is not allowed from this time on, an agent rests on its goal there
+        self.resting = dict()
+        # pos: latest vertex constraint on pos, agent can only finish at its goal after it
+        self.goal_last = dict()
+
+    def add_vertex(self, pos:tuple, t:int):
+        self.vertex.add((pos, t))
+        self.goal_last[pos] = max(self.goal_last.get(pos, -1), t)
+
+    def copy(self):
+        constraints = Constraints()
+        constraints.vertex = self.vertex.copy()
+        constraints.edge = self.edge.copy()
+        constraints.resting = self.resting.copy()
+        constraints.goal_last = self.goal_last.copy()
+        return constraints
+
+
+def space_time_astar(map:np.ndarray, start:tuple, goal:tuple, heuristic:np.ndarray, constraints:Constraints,
+                    max_steps:int, deadline:float):
+    '''
+    shortest path from start to goal that stays on goal afterwards, heuristic is the BFS distance field of goal
+    '''
+    inf = np.iinfo(heuristic.dtype).max
+    if heuristic[start] == inf:
+        return None
+
+    finish_after = constraints.goal_last.get(goal, -1)
+    if constraints.resting.get(goal, max_steps+1) <= max_steps:
+        # another agent rests on goal
+        return None
+
+    open_list = [(int(heuristic[start]), 0, start)]
+    parents = {(start, 0): None}
+    expanded = 0
+
+    while open_list:
+        _, t, pos = heapq.heappop(open_list)
+
+        if pos == goal and t > finish_after:
+            path = [pos]
+            node = parents[(pos, t)]
+            while node is not None:
+                path.append(node[0])
+                node = parents[node]
+            return path[::-1]
+
+        expanded += 1
+        if expanded % 1000 == 0 and time.time() > deadline:
+            raise Timeout
+
+        if t == max_steps:
+            continue
+
+        x, y = pos
+        for next_pos in ((x, y), (x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+            if not (0 <= next_pos[0] < map.shape[0] and 0 <= next_pos[1] < map.shape[1]) or map[next_pos] != 0:
+                continue
+            if (next_pos, t+1) in parents:
+                continue
+            if (next_pos, t+1) in constraints.vertex or constraints.resting.get(next_pos, max_steps+1) <= t+1:
+                continue
+            if (pos, next_pos, t) in constraints.edge:
+                continue
+
+            parents[(next_pos, t+1)] = (pos, t)
+            heapq.heappush(open_list, (t+1+int(heuristic[next_pos]), t+1, next_pos))
+
+    return None
+
+
+def prioritized_planning(map:np.ndarray, starts:List[tuple], goals:List[tuple], heuristics:List[np.ndarray],
+                        max_steps:int, deadline:float):
+    '''plan agents one by one, later agents avoid earlier ones, shuffle order on failure until deadline'''
+    order = list(range(len(starts)))
+
+    while True:
+        constraints = Constraints()
+        paths = [ None for _ in starts ]
+
+        for agent_id in order:
+            path = space_time_astar(map, starts[agent_id], goals[agent_id], heuristics[agent_id], constraints, max_steps, deadline)
+            if path is None:
+                break
+            paths[agent_id] = path
+
+            for t, pos in enumerate(path[:-1]):
+                constraints.add_vertex(pos, t)
+                # block swapping with this move
+                constraints.edge.add((path[t+1], pos, t))
+            constraints.resting[path[-1]] = len(path)-1
+        else:
+            return paths
+
+        if time.time() > deadline:
+            raise Timeout
+        random.shuffle(order)
+
+
+def get_pos(path:List[tuple], t:int):
+    return path[t] if t < len(path) else path[-1]
+
+
+def find_conflicts(paths:List[List[tuple]], first_only:bool=False):
+    '''
+    vertex conflict (t, i, j, pos) or swap conflict (t, i, j, pos_i, pos_j), i moves from pos_i to pos_j
+    '''
+    conflicts = []
+    for t in range(max(len(path) for path in paths)):
+        occupied = dict()
+        for agent_id, path in enumerate(paths):
+            pos = get_pos(path, t)
+            if pos in occupied:
+                conflicts.append((t, occupied[pos], agent_id, pos))
+                if first_only:
+                    return conflicts
+            else:
+                occupied[pos] = agent_id
+
+        for agent_id, path in enumerate(paths):
+            pos, next_pos = get_pos(path, t), get_pos(path, t+1)
+            other_id = occupied.get(next_pos)
+            if pos != next_pos and other_id is not None and other_id > agent_id and get_pos(paths[other_id], t+1) == pos:
+                conflicts.append((t, agent_id, other_id, pos, next_pos))
+                if first_only:
+                    return conflicts
+
+    return conflicts
+
+
+def cbs(map:np.ndarray, starts:List[tuple], goals:List[tuple], heuristics:List[np.ndarray],
+        max_steps:int, deadline:float, suboptimality:float=1.0):
+    '''
+    conflict-based search on sum of costs, with suboptimality > 1 nodes within the bound
+    are expanded in order of fewest conflicts
+    '''
+    constraints = [ Constraints() for _ in starts ]
+    paths = []
+    for agent_id in range(len(starts)):
+        path = space_time_astar(map, starts[agent_id], goals[agent_id], heuristics[agent_id], constraints[agent_id], max_steps, deadline)
+        if path is None:
+            return None
+        paths.append(path)
+
+    # (cost, number of conflicts, node id, constraints, paths)
+    open_list = [(sum(len(path)-1 for path in paths), len(find_conflicts(paths)), 0, constraints, paths)]
+    node_id = 1
+
+    while open_list:
+        if time.time() > deadline:
+            raise Timeout
+
+        if suboptimality > 1:
+            bound = suboptimality * min(node[0] for node in open_list)
+            node = min((node for node in open_list if node[0] <= bound), key=lambda node: (node[1], node[0]))
+            open_list.remove(node)
+        else:
+            node = heapq.heappop(open_list)
+        _, _, _, constraints, paths = node
+
+        conflicts = find_conflicts(paths, first_only=True)
+        if not conflicts:
+            return paths
+
+        conflict = conflicts[0]
+        t, agent_i, agent_j = conflict[:3]
+        if len(conflict) == 4:
+            branches = [ (agent_i, ('vertex', conflict[3], t)), (agent_j, ('vertex', conflict[3], t)) ]
+        else:
+            pos_i, pos_j = conflict[3], conflict[4]
+            branches = [ (agent_i, ('edge', (pos_i, pos_j, t))), (agent_j, ('edge', (pos_j, pos_i, t))) ]
+
+        for agent_id, constraint in branches:
+            child_constraints = list(constraints)
+            child_constraints[agent_id] = constraints[agent_id].copy()
+            if constraint[0] == 'vertex':
+                child_constraints[agent_id].add_vertex(constraint[1], constraint[2])
+            else:
+                child_constraints[agent_id].edge.add(constraint[1])
+
+            path = space_time_astar(map, starts[agent_id], goals[agent_id], heuristics[agent_id], child_constraints[agent_id], max_steps, deadline)
+            if path is None:
+                continue
+
+            child_paths = list(paths)
+            child_paths[agent_id] = path
+            cost = sum(len(path)-1 for path in child_paths)
+            num_conflicts = len(find_conflicts(child_paths)) if suboptimality > 1 else 0
+
+            if suboptimality > 1:
+                open_list.append((cost, num_conflicts, node_id, child_constraints, child_paths))
+            else:
+                heapq.heappush(open_list, (cost, num_conflicts, node_id, child_constraints, child_paths))
+            node_id += 1
+
+    return None
+
+
+def solve(map:np.ndarray, agents_pos:np.ndarray, goals_pos:np.ndarray, method:str='pp', timeout:float=10,
+        suboptimality:float=1.0, max_steps:int=config.max_steps):
+    '''
+    return path of each agent as list of positions, all agents stay on goal after their path ends,
+    None if no solution is found within timeout
+    '''
+    starts = [ tuple(int(i) for i in pos) for pos in agents_pos ]
+    goals = [ tuple(int(i) for i in pos) for pos in goals_pos ]
+    deadline = time.time() + timeout
+
+    # distance fields of the environment as heuristic
+    heuristics = [ bfs_distance(map, goal) for goal in goals ]
+
+    try:
+        if method == 'pp':
+            return prioritized_planning(map, starts, goals, heuristics, max_steps, deadline)
+        elif method == 'cbs':
+            return cbs(map, starts, goals, heuristics, max_steps, deadline, suboptimality)
+        else:
+            raise RuntimeError('method does not support')
+    except Timeout:
+        return None
+
+
+def paths_to_actions(paths:List[List[tuple]]):
+    '''convert paths to action lists for Environment.step, one list per step'''
+    makespan = max(len(path) for path in paths) - 1
+    actions = []
+    for t in range(makespan):
+        step_actions = []
+        for path in paths:
+            move = np.subtract(get_pos(path, t+1), get_pos(path, t))
+            step_actions.append(int(np.flatnonzero(np.all(action_list==move, axis=1))[0]))
+        actions.append(step_actions)
+
+    return actions
+
+
+def _solve_case(args):
+    map, agents_pos, goals_pos, method, timeout, suboptimality = args
+    paths = solve(map, agents_pos, goals_pos, method, timeout, suboptimality)
+    if paths is None:
+        return None
+    # cbs minimises the first, the environment counts the second as episode steps
+    return sum(len(path)-1 for path in paths), max(len(path) for path in paths) - 1
+
+
+def solve_tests(tests:dict, method:str='pp', timeout:float=10, suboptimality:float=1.0, processes:int=None):
+    '''
+    solve all cases of a test dict in a process pool, return (sum of costs, makespan) of each case
+    or None if unsolved
+    '''
+    cases = [ (map, agents_pos, goals_pos, method, timeout, suboptimality)
+                for map, agents_pos, goals_pos in zip(tests['maps'], tests['agents'], tests['goals']) ]
+
+    with Pool(processes) as pool:
+        return list(pool.imap(_solve_case, cases, chunksize=1))
@@ -1,17 +1,16 @@
 import numpy as np
 import torch
 from environment import Environment
-from model import Network
+from model import Network, load_network
+from checkpoint import read_index
 from tqdm import tqdm
 import pickle
 import os
-import matplotlib as mpl
-mpl.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 import random
 import time
 import config
+from solver import solve_tests
+from render import save_gif
 torch.manual_seed(1)
 np.random.seed(1)
 random.seed(1)
@@ -19,65 +18,7 @@ test_num = 200
 device = torch.device('cuda')
 # device = torch.device('cpu')
 
-# def create_test(agent_range:Union[int,list,tuple], map_range:Union[int,list,tuple], density=None):
-
-#     name = './test{}_{}.pkl'.format(agent_range, map_range)
-
-#     tests = {'maps': [], 'agents': [], 'goals': [], 'opt_steps': []}
-
-#     if type(agent_range) is int:
-#         num_agents = agent_range
-#     elif type(agent_range) is list:
-#         num_agents = random.choice(agent_range)
-#     else:
-#         num_agents = random.randint(agent_range[0], agent_range[1])
-
-#     if type(map_range) is int:
-#         map_length = map_range
-#     elif type(map_range) is list:
-#         map_length = random.choice(map_range)
-#     else:
-#         map_length = random.randint(map_range[0]//5, map_range[1]//5) * 5
-
-#     env = Environment(fix_density=None, num_agents=num_agents, map_length=map_length)
-
-#     for _ in tqdm(range(test_num)):
-#         tests['maps'].append(np.copy(env.map))
-#         tests['agents'].append(np.copy(env.agents_pos))
-#         tests['goals'].append(np.copy(env.goals_pos))
-
-#         actions = find_path(env)
-#         while actions is None:
-#             env.reset()
-#             tests['maps'][-1] = np.copy(env.map)
-#             tests['agents'][-1] = np.copy(env.agents_pos)
-#             tests['goals'][-1] = np.copy(env.goals_pos)
-#             actions = find_path(env)
-
-#         tests['opt_steps'].append(len(actions))
-
-#         if type(agent_range) is int:
-#             num_agents = agent_range
-#         elif type(agent_range) is list:
-#             num_agents = random.choice(agent_range)
-#         else:
-#             num_agents = random.randint(agent_range[0], agent_range[1])
-
-#         if type(map_range) is int:
-#             map_length = map_range
-#         elif type(map_range) is list:
-#             map_length = random.choice(map_range)
-#         else:
-#             map_length = random.randint(map_range[0]//5, map_range[1]//5) * 5
-
-#         env.reset(num_agents=num_agents, map_length=map_length)
-
-#     tests['opt_mean_steps'] = sum(tests['opt_steps']) / len(tests['opt_steps'])
-
-#     with open(name, 'wb') as f:
-#         pickle.dump(tests, f)
-
-def create_test(num_agents:int, map_length:int, density=None):
+def create_test(num_agents:int, map_length:int, density=None, method:str=None):
 
     name = './test{}_{}_{}.pkl'.format(num_agents, map_length, density)
 
@@ -97,20 +38,48 @@ def create_test(num_agents:int, map_length:int, density=None):
     with open(name, 'wb') as f:
         pickle.dump(tests, f)
 
+    if method is not None:
+        annotate_test(name, method)
 
-def test_model(test_case='test16_40_0.3.pkl'):
 
-    network = Network()
-    network.eval()
-    network.to(device)
+def annotate_test(test_case:str, method:str='pp', timeout:float=10, suboptimality:float=1.0, processes:int=None):
+    '''
+    add reference sum of costs and makespan of each case from solver, unsolved cases are None.
+    Only the sum of costs of cbs without suboptimality is optimal, ref_soc_optimal tells which
+    '''
 
     with open(test_case, 'rb') as f:
         tests = pickle.load(f)
 
-    model_name = 462500
-    while os.path.exists('./models/{}.pth'.format(model_name)):
-        state_dict = torch.load('./models/{}.pth'.format(model_name), map_location=device)
-        network.load_state_dict(state_dict)
+    start = time.time()
+    results = solve_tests(tests, method, timeout, suboptimality, processes)
+    tests['ref_method'] = (method, suboptimality)
+    tests['ref_soc_optimal'] = method == 'cbs' and suboptimality == 1
+    tests['ref_soc'] = [ result[0] if result is not None else None for result in results ]
+    tests['ref_makespan'] = [ result[1] if result is not None else None for result in results ]
+    solved = [ steps for steps in tests['ref_makespan'] if steps is not None ]
+    tests['ref_mean_makespan'] = sum(solved) / len(solved) if solved else None
+
+    print('{}: solved {}/{} in {:.2f}s, mean makespan {}'.format(test_case, len(solved), len(results),
+                                                            time.time()-start, tests['ref_mean_makespan']))
+
+    with open(test_case, 'wb') as f:
+        pickle.dump(tests, f)
+
+
+def test_model(test_case='test16_40_0.3.pkl'):
+
+    with open(test_case, 'rb') as f:
+        tests = pickle.load(f)
+
+    # best evaluated model first, then checkpoints from the latest
+    index = read_index(config.save_path)
+    model_names = [ entry['file'] for entry in reversed(index['checkpoints']) ]
+    if index['best'] is not None:
+        model_names.insert(0, index['best']['file'])
+
+    for model_name in model_names:
+        network = load_network(os.path.join(config.save_path, model_name), device)
         env = Environment()
 
         case = 2
@@ -123,14 +92,13 @@ def test_model(test_case='test16_40_0.3.pkl'):
 
         for i in range(test_num):
             env.load(tests['maps'][i], tests['agents'][i], tests['goals'][i])
+            if i == case and show:
+                env.start_record()
             
             done = False
             network.reset()
 
             while not done and env.steps < config.max_steps:
-                if i == case and show and env.steps < show_steps:
-                    env.render()
-
                 obs_pos = env.observe()
 
                 actions, q_vals, _ = network.step(torch.FloatTensor(obs_pos).to(device))
@@ -153,7 +121,8 @@ def test_model(test_case='test16_40_0.3.pkl'):
 
 
             if i == case and show:
-                env.close(True)
+                save_gif(env.get_trajectory(), './case{}.gif'.format(case))
+                env.stop_record()
         
         f_rate = (test_num-fail)/test_num
         mean_steps = sum(steps)/test_num
@@ -162,17 +131,11 @@ def test_model(test_case='test16_40_0.3.pkl'):
         print('--------------{}---------------'.format(model_name))
         print('finish: %.4f' %f_rate)
         print('mean steps: %.2f' %mean_steps)
+        if tests.get('ref_mean_makespan') is not None:
+            print('reference mean steps: %.2f (%s)' %(tests['ref_mean_makespan'], tests['ref_method'][0]))
         print('time spend: %.2f' %duration)
 
-
-        model_name -= config.save_interval
-
 def make_animation():
-    color_map = np.array([[255, 255, 255],   # white
-                    [190, 190, 190],   # gray
-                    [0, 191, 255],   # blue
-                    [255, 165, 0],   # orange
-                    [0, 250, 154]])  # green
 
     test_name = 'test4.pkl'
     with open(test_name, 'rb') as f:
@@ -189,43 +152,17 @@ def make_animation():
 
     env = Environment()
     env.load(tests['maps'][test_case], tests['agents'][test_case], tests['goals'][test_case])
-
-    fig = plt.figure()
+    env.start_record()
             
     done = False
-    obs_pos = env.observe()
+    obs = env.observe()
 
-    imgs = []
     while not done and env.steps < steps:
-        imgs.append([])
-        map = np.copy(env.map)
-        for agent_id in range(env.num_agents):
-            if np.array_equal(env.agents_pos[agent_id], env.goals_pos[agent_id]):
-                map[tuple(env.agents_pos[agent_id])] = 4
-            else:
-                map[tuple(env.agents_pos[agent_id])] = 2
-                map[tuple(env.goals_pos[agent_id])] = 3
-        map = map.astype(np.uint8)
-
-        img = plt.imshow(color_map[map], animated=True)
-
-        imgs[-1].append(img)
-
-        for i, ((agent_x, agent_y), (goal_x, goal_y)) in enumerate(zip(env.agents_pos, env.goals_pos)):
-            text = plt.text(agent_y, agent_x, i, color='black', ha='center', va='center')
-            imgs[-1].append(text)
-            text = plt.text(goal_y, goal_x, i, color='black', ha='center', va='center')
-            imgs[-1].append(text)
-
-
-        actions, _, _ = network.step(torch.from_numpy(obs_pos[0].astype(np.float32)).to(device), torch.from_numpy(obs_pos[1].astype(np.float32)).to(device))
-        obs_pos, _, done, _ = env.step(actions)
+        actions, _, _ = network.step(torch.from_numpy(obs.astype(np.float32)).to(device))
+        obs, _, done, _ = env.step(actions)
         # print(done)
 
-    ani = animation.ArtistAnimation(fig, imgs, interval=500, blit=True,
-                                repeat_delay=1000)
-
-    ani.save('dynamic_images.mp4')
+    save_gif(env.get_trajectory(), 'dynamic_images.gif')
 
     
 
@@ -1,46 +1,98 @@
 import os
-os.environ["OMP_NUM_THREADS"] = "1"
 import torch
 import numpy as np
 import random
 
-from worker import GlobalBuffer, Learner, Actor
+from worker import GlobalBuffer, Learner, Actor, BatchSampler, Evaluator
+from metrics import MetricsExporter
+from buffer import SharedArrays
 import time
-import ray
 import threading
+import atexit
 
 import config
+import runtime
+import resources
 
 torch.manual_seed(0)
 np.random.seed(0)
 random.seed(0)
 
 if __name__ == '__main__':
-    ray.init()
+    runtime.init()
 
-    buffer = GlobalBuffer.remote(2048)
-    learner = Learner.remote(buffer)
-    num_actors = 16
-    time.sleep(5)
-    actors = [Actor.remote(i, 0.4**(1+(i/(num_actors-1))*7), learner, buffer) for i in range(num_actors)]
+    os.makedirs(config.save_path, exist_ok=True)
+
+    plan = resources.plan()
+    resources.summary(plan)
+
+    buffer = GlobalBuffer.remote(config.buffer_capacity)
+    if config.load_model is not None:
+        runtime.get(buffer.restore.remote())
+    if config.num_samplers > 0:
+        specs = runtime.get(buffer.shared_specs.remote())
+        # atexit of the global buffer does not run when ray kills it
+        atexit.register(SharedArrays.unlink, specs)
+        samplers = [ BatchSampler.remote(i, buffer, specs) for i in range(config.num_samplers) ]
+    else:
+        samplers = []
+    if config.num_learners > 1:
+        # data parallel learners on cpu
+        learners = [ Learner.options(num_gpus=0).remote(buffer, rank, config.num_learners) for rank in range(config.num_learners) ]
+    else:
+        learners = [ Learner.remote(buffer) ]
+    learner = learners[0]
+    evaluators = [ Evaluator.remote(learner) ] if config.eval_interval is not None else []
+    exporter = MetricsExporter()
+    num_actors = len(plan['actors'])
+    # epsilon decreases with actor id, the quarter with the lowest records curriculum outcomes
+    actors = [Actor.remote(i, 0.4**(1+(i/max(num_actors-1, 1))*7), learner, buffer, i >= num_actors*3//4) for i in range(num_actors)]
+
+    # before run, which starts the threads that should inherit the affinity
+    runtime.get([ buffer.set_resources.remote(*plan['buffer']) ]
+                + [ s.set_resources.remote(*r) for s, r in zip(samplers, plan['samplers']) ]
+                + [ l.set_resources.remote(*r) for l, r in zip(learners, plan['learners']) ]
+                + [ e.set_resources.remote(*plan['evaluator']) for e in evaluators ]
+                + [ a.set_resources.remote(*r) for a, r in zip(actors, plan['actors']) ])
 
     for actor in actors:
         actor.run.remote()
     
-    while not ray.get(buffer.ready.remote()):
-        time.sleep(5)
-        ray.get(learner.stats.remote(5))
-        ray.get(buffer.stats.remote(5))
+    last_snapshot = time.time()
+    # returns as soon as the buffer is ready, stats every 5 seconds until then
+    last_stats = time.time()
+    while not runtime.get(buffer.wait_ready.remote(5)):
+        interval = time.time()-last_stats
+        last_stats = time.time()
+        runtime.get(learner.stats.remote(interval))
+        runtime.get(buffer.stats.remote(interval))
+
+        if time.time()-last_snapshot >= config.buffer_snapshot_interval:
+            buffer.snapshot.remote()
+            last_snapshot = time.time()
 
     print('start training')
     buffer.run.remote()
-    learner.run.remote()
+    for sampler in samplers:
+        sampler.run.remote()
+    for l in learners:
+        l.run.remote()
+    for evaluator in evaluators:
+        evaluator.run.remote()
     
     done = False
     interval = 10
     while not done:
         time.sleep(interval)
         
-        done = ray.get(learner.stats.remote(interval))
-        ray.get(buffer.stats.remote(interval))
+        done = runtime.get(learner.stats.remote(interval))
+        runtime.get(buffer.stats.remote(interval))
+
+        for snapshots in runtime.get([ l.get_metrics.remote() for l in learners ] + [ e.get_metrics.remote() for e in evaluators ] + [ buffer.get_metrics.remote() ]):
+            exporter.update(snapshots)
+        exporter.summary()
         print()
+
+        if time.time()-last_snapshot >= config.buffer_snapshot_interval:
+            buffer.snapshot.remote()
+            last_snapshot = time.time()
@@ -0,0 +1,219 @@
+'''
+Environments stepped in worker processes, for evaluation and annotation scripts outside of training
+
+    envs = VectorEnv(8, max_agents=16, num_agents=4, map_length=20)
+    obs, masks = envs.reset()
+    envs.step_async(actions)            # (num_envs, max_agents), padded agents are ignored
+    obs, rewards, dones, infos, masks = envs.step_wait()
+    envs.close()
+
+Observations, actions and rewards go through shared memory, only commands and infos through pipes.
+Agents of every environment are padded to max_agents and masks marks the real ones, so environments
+can have different numbers of agents. An environment whose episode ends, at goal or after max_steps
+(infos[i]['truncated']), is reset with its last reset arguments and its last observation is
+kept in infos[i]['final_obs']. An exception in a worker is raised as RuntimeError with its traceback
+by the call that waits for the reply.
+'''
+import random
+import traceback
+from typing import List
+
+import numpy as np
+import torch.multiprocessing as mp
+
+import config
+from buffer import SharedArrays
+from environment import Environment
+
+
+def env_worker(index:int, pipe, arrays:dict, env_kwargs:dict, max_steps:int, seed:int):
+    np.random.seed(seed)
+    random.seed(seed)
+
+    obs_buf, act_buf, rew_buf, mask_buf = arrays['obs'], arrays['act'], arrays['rew'], arrays['mask']
+    env = Environment(**env_kwargs)
+    reset_kwargs = dict()
+
+    def write_obs(obs:np.ndarray):
+        num_agents = obs.shape[0]
+        if num_agents > obs_buf.shape[1]:
+            raise RuntimeError('{} agents is more than max_agents {}'.format(num_agents, obs_buf.shape[1]))
+        obs_buf[index, :num_agents] = obs
+        obs_buf[index, num_agents:] = 0
+        mask_buf[index, :num_agents] = True
+        mask_buf[index, num_agents:] = False
+
+    while True:
+        cmd, data = pipe.recv()
+        if cmd == 'close':
+            pipe.close()
+            return
+
+        # errors are sent to the parent, which raises them
+        try:
+            if cmd == 'reset':
+                if data is not None:
+                    reset_kwargs = data
+                write_obs(env.reset(**reset_kwargs))
+                reply = None
+
+            elif cmd == 'load':
+                env.load(*data)
+                write_obs(env.observe())
+                reply = None
+
+            elif cmd == 'step':
+                num_agents = env.num_agents
+                obs, rewards, done, info = env.step(act_buf[index, :num_agents].tolist())
+                rew_buf[index, :num_agents] = rewards
+                rew_buf[index, num_agents:] = 0
+
+                info['truncated'] = not done and env.steps >= max_steps
+                if done or info['truncated']:
+                    info['final_obs'] = obs
+                    info['steps'] = env.steps
+                    obs = env.reset(**reset_kwargs)
+                    done = True
+                write_obs(obs)
+                reply = (done, info)
+
+            elif cmd == 'get_attr':
+                reply = getattr(env, data)
+
+        except Exception:
+            pipe.send(('error', traceback.format_exc()))
+        else:
+            pipe.send(('ok', reply))
+
+
+class VectorEnv:
+    def __init__(self, num_envs:int, max_agents:int=config.max_num_agetns, max_steps:int=config.max_steps, seed:int=0, **env_kwargs):
+        '''num_envs Environment(**env_kwargs) in forked processes'''
+        self.num_envs = num_envs
+        self.max_agents = max_agents
+
+        self.shared = SharedArrays()
+        arrays = {
+            'obs': self.shared.create('obs', (num_envs, max_agents, *config.obs_shape), np.bool),
+            'act': self.shared.create('act', (num_envs, max_agents), np.int64),
+            'rew': self.shared.create('rew', (num_envs, max_agents), np.float32),
+            'mask': self.shared.create('mask', (num_envs, max_agents), np.bool),
+        }
+        self.obs_buf, self.act_buf, self.rew_buf, self.mask_buf = arrays['obs'], arrays['act'], arrays['rew'], arrays['mask']
+
+        ctx = mp.get_context('fork')
+        self.pipes = []
+        self.processes = []
+        for i in range(num_envs):
+            pipe, child_pipe = ctx.Pipe()
+            process = ctx.Process(target=env_worker, args=(i, child_pipe, arrays, env_kwargs, max_steps, seed+i), daemon=True)
+            process.start()
+            child_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+        # environments with a command whose reply is not read yet
+        self.waiting = []
+        self.stepping = False
+        self.closed = False
+
+    def reset_async(self, indices:List[int]=None, **reset_kwargs):
+        '''
+        reset environments, all by default, with Environment.reset arguments (level, num_agents, map_length),
+        which are also used by auto reset, no arguments keep the last ones
+        '''
+        assert not self.stepping, 'step_wait should be called after step_async'
+        levels = reset_kwargs.get('level') or [(reset_kwargs.get('num_agents') or 0, None)]
+        assert all(num_agents <= self.max_agents for num_agents, _ in levels), 'more agents than max_agents'
+        indices = range(self.num_envs) if indices is None else indices
+        for i in indices:
+            self.pipes[i].send(('reset', reset_kwargs or None))
+            self.waiting.append(i)
+
+    def reset_wait(self, copy:bool=True):
+        '''wait for resets and loads, return observations and agent masks of all environments'''
+        waiting, self.waiting = self.waiting, []
+        self.recv(waiting)
+        return self.observations(copy)
+
+    def reset(self, indices:List[int]=None, copy:bool=True, **reset_kwargs):
+        self.reset_async(indices, **reset_kwargs)
+        return self.reset_wait(copy)
+
+    def load_async(self, index:int, map:np.ndarray, agents_pos:np.ndarray, goals_pos:np.ndarray):
+        '''load a test case like Environment.load, finished with reset_wait'''
+        assert not self.stepping, 'step_wait should be called after step_async'
+        assert agents_pos.shape[0] <= self.max_agents, 'more agents than max_agents'
+        self.pipes[index].send(('load', (map, agents_pos, goals_pos)))
+        self.waiting.append(index)
+
+    def step_async(self, actions:np.ndarray):
+        '''actions of shape (num_envs, max_agents), those of padded agents are ignored'''
+        assert not self.stepping and not self.waiting, 'previous commands are not finished'
+        self.act_buf[:] = np.asarray(actions).reshape(self.num_envs, self.max_agents)
+        for pipe in self.pipes:
+            pipe.send(('step', None))
+        self.stepping = True
+
+    def step_wait(self, copy:bool=True):
+        '''return observations, rewards and masks of shape (num_envs, max_agents, ...), dones and infos of each environment'''
+        assert self.stepping, 'step_async is not called'
+        self.stepping = False
+        replies = self.recv(range(self.num_envs))
+        dones = np.array([ done for done, _ in replies ], dtype=np.bool)
+        infos = [ info for _, info in replies ]
+
+        obs, masks = self.observations(copy)
+        rewards = np.copy(self.rew_buf) if copy else self.rew_buf
+        return obs, rewards, dones, infos, masks
+
+    def step(self, actions:np.ndarray, copy:bool=True):
+        self.step_async(actions)
+        return self.step_wait(copy)
+
+    def observations(self, copy:bool=True):
+        '''without copy the arrays are overwritten by the next step'''
+        if copy:
+            return np.copy(self.obs_buf), np.copy(self.mask_buf)
+        return self.obs_buf, self.mask_buf
+
+    def get_attr(self, name:str):
+        '''attribute of every environment, e.g. agents_pos'''
+        assert not self.stepping and not self.waiting, 'previous commands are not finished'
+        for pipe in self.pipes:
+            pipe.send(('get_attr', name))
+        return self.recv(range(self.num_envs))
+
+    def recv(self, indices:List[int]):
+        '''replies of environments, raise the first error after all of them are read'''
+        replies = []
+        error = None
+        for i in indices:
+            status, reply = self.pipes[i].recv()
+            if status == 'error' and error is None:
+                error = 'environment {} failed:\n{}'.format(i, reply)
+            replies.append(reply)
+        if error is not None:
+            raise RuntimeError(error)
+        return replies
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.stepping or self.waiting:
+                for i in (range(self.num_envs) if self.stepping else self.waiting):
+                    self.pipes[i].recv()
+            for pipe in self.pipes:
+                pipe.send(('close', None))
+        except (OSError, EOFError):
+            # workers already terminated at interpreter exit
+            pass
+        for process in self.processes:
+            process.join()
+        self.shared.close()
+        self.closed = True
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            self.close()
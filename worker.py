@@ -1,24 +1,199 @@
-import ray
 import time
 import random
 import os
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 from torch.optim import Adam
 from torch.optim.lr_scheduler import MultiStepLR
 import numpy as np
 from copy import deepcopy
 from typing import List, Tuple
 import threading
+import pickle
+import json
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import config
+import runtime
 from model import Network
 from environment import Environment
-from buffer import SumTree, LocalBuffer
-
-@ray.remote(num_cpus=1)
+from buffer import SumTree, LocalBuffer, HiddenStore, RateLimiter, SharedArrays, ObsPool, obs_storage, decode_obs
+from metrics import Metrics
+from curriculum import Curriculum
+from checkpoint import CheckpointWriter, snapshot, load_checkpoint, latest_checkpoint
+from evaluation import evaluate_batched
+import resources
+
+def assemble_batch(replay, idxes:np.ndarray, weights:np.ndarray, ptr:int, versions:np.ndarray=None) -> Tuple:
+    '''
+    build training batch of sampled idxes from replay arrays of a GlobalBuffer or BatchSampler,
+    with slot versions given samples whose slot is written during assembly get zero weight
+    '''
+    b_obs, b_action, b_reward, b_done, b_steps, b_bt_steps, = [], [], [], [], [], []
+    b_hidden = []
+    seq_len = config.bt_steps+config.forward_steps
+
+    global_idxes = idxes // config.local_buffer_size
+    local_idxes = idxes % config.local_buffer_size
+    torn = np.zeros(idxes.shape[0], dtype=np.bool)
+
+    for i, (idx, global_idx, local_idx) in enumerate(zip(idxes.tolist(), global_idxes.tolist(), local_idxes.tolist())):
+
+        if versions is not None and replay.slot_version[global_idx] != versions[i]:
+            # overwritten since sampled, placeholder without loss
+            torn[i] = True
+            b_obs.append(np.zeros((seq_len, *config.obs_shape), dtype=np.bool))
+            b_action.append(0)
+            b_reward.append(0)
+            b_done.append(True)
+            b_steps.append(1)
+            b_bt_steps.append(1)
+            b_hidden.append(np.zeros(config.latent_dim, dtype=np.float32))
+            continue
+
+        assert local_idx < replay.size_buf[global_idx]
+
+        steps = int(min(config.forward_steps, (replay.size_buf[global_idx]-local_idx).item()))
+        # burn-in starts after the closest stored hidden state
+        start_step = replay.hidden_store.start_step(local_idx)
+        bt_steps = local_idx-start_step
+        hidden = replay.hidden_store.get(global_idx, start_step)
+        # print(idx+global_idx-bt_steps+1)
+        # print(idx+global_idx+1+steps)
+        obs_rows = replay.obs_buf[idx+global_idx-bt_steps+1:idx+global_idx+1+steps]
+        # handles into the observation pool with deduplication
+        obs = decode_obs(replay.obs_pool[obs_rows] if config.obs_dedup else np.copy(obs_rows))
+
+        if obs.shape[0] < seq_len:
+            pad_len = seq_len-obs.shape[0]
+            obs = np.pad(obs, ((0,pad_len),(0,0),(0,0),(0,0)))
+
+        action = replay.act_buf[idx]
+        reward = 0
+        for j in range(steps):
+            reward += replay.rew_buf[idx+j]*0.99**j
+
+        if local_idx >= replay.size_buf[global_idx]-config.forward_steps and replay.done_buf[global_idx]:
+            done = True
+        else:
+            done = False
+
+        if versions is not None and replay.slot_version[global_idx] != versions[i]:
+            torn[i] = True
+
+        b_obs.append(obs)
+        b_action.append(action)
+        b_reward.append(reward)
+
+        b_done.append(done)
+        b_steps.append(steps)
+        b_bt_steps.append(bt_steps)
+
+        b_hidden.append(hidden)
+
+    weights = np.where(torn, 0, weights)
+
+    # sort by sequence length so Network.bootstrap can pack without sorting
+    b_bt_steps = np.array(b_bt_steps)
+    order = np.lexsort((-b_bt_steps, -(b_bt_steps+np.array(b_steps))))
+    b_obs, b_action, b_reward = [b_obs[i] for i in order], [b_action[i] for i in order], [b_reward[i] for i in order]
+    b_done, b_steps, b_hidden = [b_done[i] for i in order], [b_steps[i] for i in order], [b_hidden[i] for i in order]
+    b_bt_steps = b_bt_steps[order].tolist()
+    idxes, weights = idxes[order], weights[order]
+    b_target_q, b_target_version = replay.target_q_buf[idxes], replay.target_version_buf[idxes]
+
+    data = (
+        torch.from_numpy(np.stack(b_obs).astype(np.float32)),
+        torch.LongTensor(b_action).unsqueeze(1),
+        torch.FloatTensor(b_reward).unsqueeze(1),
+
+        torch.FloatTensor(b_done).unsqueeze(1),
+        torch.FloatTensor(b_steps).unsqueeze(1),
+        b_bt_steps,
+        torch.from_numpy(np.stack(b_hidden)),
+        torch.from_numpy(b_target_q).unsqueeze(1),
+        b_target_version,
+
+        idxes,
+        torch.from_numpy(weights).unsqueeze(1),
+        ptr
+    )
+
+    return data
+
+
+def replay_memory(capacity:int):
+    '''bytes of each GlobalBuffer component for capacity episode slots'''
+    obs_shape, obs_dtype = obs_storage()
+    obs_bytes = int(np.prod(obs_shape))*np.dtype(obs_dtype).itemsize
+    hidden_store = HiddenStore(0)
+    transitions = capacity*config.local_buffer_size
+
+    if config.obs_dedup:
+        pool_rows = obs_pool_rows(capacity)
+        obs_memory = {
+            'obs_buf': (config.max_steps+1)*capacity*4,
+            'obs_pool': pool_rows*obs_bytes,
+            'obs_refcount': pool_rows*4,
+            # hash table of the pool is not counted
+            'obs_pool_index': pool_rows*9,
+        }
+    else:
+        obs_memory = {'obs_buf': (config.max_steps+1)*capacity*obs_bytes}
+
+    return {
+        **obs_memory,
+        'act_buf': config.max_steps*capacity,
+        'rew_buf': config.max_steps*capacity*4,
+        'hid_buf': capacity*hidden_store.slot_len*config.latent_dim*hidden_store.buf.dtype.itemsize,
+        'done_buf': capacity,
+        'size_buf': capacity*np.dtype(np.uint).itemsize,
+        'target_q_buf': transitions*4,
+        'target_version_buf': transitions*4,
+        'slot_version': capacity*8,
+        'priority_tree': (2*transitions-1)*8,
+    }
+
+
+def obs_pool_rows(capacity:int):
+    '''rows of observation pool, at least one episode'''
+    return max(int(config.obs_pool_ratio*(config.max_steps+1)*capacity), config.max_steps+1)
+
+
+def buffer_capacity(budget:int):
+    '''largest number of episode slots within budget bytes, a power of 2 for SumTree'''
+    capacity = 1
+    while sum(replay_memory(capacity*2).values()) <= budget:
+        capacity *= 2
+    if sum(replay_memory(capacity).values()) > budget:
+        raise RuntimeError('buffer memory budget {} bytes is less than one episode slot'.format(budget))
+    return capacity
+
+
+def format_bytes(num:int):
+    for unit in ('B', 'KiB', 'MiB'):
+        if num < 1024:
+            return '{:.1f} {}'.format(num, unit)
+        num /= 1024
+    return '{:.2f} GiB'.format(num)
+
+
+# second thread lets wait_ready block without holding up adds
+@runtime.remote(num_cpus=1, max_concurrency=2)
 class GlobalBuffer:
-    def __init__(self, capacity, alpha=config.prioritized_replay_alpha, beta=config.prioritized_replay_beta):
+    def __init__(self, capacity=None, alpha=config.prioritized_replay_alpha, beta=config.prioritized_replay_beta):
+        # sized by memory budget if capacity is not given
+        if capacity is None:
+            if config.buffer_memory_budget is None:
+                raise RuntimeError('buffer capacity or config.buffer_memory_budget should be set')
+            capacity = buffer_capacity(config.buffer_memory_budget)
+        elif config.buffer_memory_budget is not None and sum(replay_memory(capacity).values()) > config.buffer_memory_budget:
+            raise RuntimeError('buffer of {} slots needs {}, more than budget {}'.format(capacity,
+                format_bytes(sum(replay_memory(capacity).values())), format_bytes(config.buffer_memory_budget)))
+
         self.capacity = capacity
         self.size = 0
         self.ptr = 0
@@ -27,223 +202,493 @@ class GlobalBuffer:
         self.beta = beta
         self.counter = 0
         self.data = []
-        self.stat_dict = {config.init_set:[]}
+        self.curriculum = Curriculum()
         self.lock = threading.Lock()
-        self.level = ray.put([config.init_set])
-
-        self.obs_buf = np.zeros(((config.max_steps+1)*capacity, *config.obs_shape), dtype=np.bool)
-        self.act_buf = np.zeros((config.max_steps*capacity), dtype=np.uint8)
-        self.rew_buf = np.zeros((config.max_steps*capacity), dtype=np.float32)
-        self.hid_buf = np.zeros((config.max_steps*capacity, config.latent_dim), dtype=np.float32)
-        self.cell_buf = np.zeros((config.max_steps*capacity, config.latent_dim), dtype=np.float32)
-        self.done_buf = np.zeros(capacity, dtype=np.bool)
-        self.size_buf = np.zeros(capacity, dtype=np.uint)
+        self.ready_event = threading.Event()
+
+        # replay arrays are read by batch samplers from shared memory if there are any
+        self.shared = SharedArrays() if config.num_samplers > 0 else None
+        if self.shared is not None:
+            atexit.register(self.shared.close)
+
+        obs_shape, obs_dtype = obs_storage()
+        if config.obs_dedup:
+            self.obs_buf = self.new_array('obs_buf', (config.max_steps+1)*capacity, np.uint32)
+            self.obs_pool = self.new_array('obs_pool', (obs_pool_rows(capacity), *obs_shape), obs_dtype)
+            self.obs_store = ObsPool(self.obs_pool)
+        else:
+            self.obs_buf = self.new_array('obs_buf', ((config.max_steps+1)*capacity, *obs_shape), obs_dtype)
+            self.obs_store = None
+        # episodes dropped before being overwritten to free observation pool rows
+        self.evicted = 0
+        self.act_buf = self.new_array('act_buf', (config.max_steps*capacity), np.uint8)
+        self.rew_buf = self.new_array('rew_buf', (config.max_steps*capacity), np.float32)
+        self.hidden_store = HiddenStore(capacity)
+        self.hidden_store.buf = self.new_array('hid_buf', self.hidden_store.buf.shape, self.hidden_store.buf.dtype)
+        self.done_buf = self.new_array('done_buf', capacity, np.bool)
+        self.size_buf = self.new_array('size_buf', capacity, np.uint)
+        # target bootstrap value of each transition and target network version it was computed with, -1 if none
+        self.target_q_buf = self.new_array('target_q_buf', capacity*config.local_buffer_size, np.float32)
+        self.target_version_buf = self.new_array('target_version_buf', capacity*config.local_buffer_size, np.int32)
+        self.target_version_buf[:] = -1
+        # seqlock of each slot, odd while the slot is written
+        self.slot_version = self.new_array('slot_version', capacity, np.int64)
+
+        # slots written since last snapshot
+        self.dirty_slots = set()
+        self.snapshot_files = None
+        self.snapshot_lock = threading.Lock()
+
+        self.rate_limiter = RateLimiter()
+
+        self.metrics = Metrics('buffer')
+        # snapshots pushed by actors
+        self.actor_metrics = dict()
+
+        self.print_memory()
 
     def __len__(self):
         return self.size
 
+    def memory_usage(self):
+        '''bytes of each component'''
+        usage = { name: array.nbytes for name, (array, _) in self.snapshot_arrays().items() }
+        usage['target_q_buf'] = self.target_q_buf.nbytes
+        usage['target_version_buf'] = self.target_version_buf.nbytes
+        usage['slot_version'] = self.slot_version.nbytes
+        if self.obs_store is not None:
+            usage['obs_pool_index'] = self.obs_store.keys.nbytes + self.obs_store.indexed.nbytes
+        return usage
+
+    def print_memory(self):
+        usage = self.memory_usage()
+        total = sum(usage.values())
+        if config.buffer_memory_budget is None:
+            print('buffer memory: {} for {} slots'.format(format_bytes(total), self.capacity))
+        else:
+            print('buffer memory: {} of budget {} for {} slots'.format(format_bytes(total), format_bytes(config.buffer_memory_budget), self.capacity))
+        for name, num in sorted(usage.items(), key=lambda item: -item[1]):
+            print('    {}: {} ({:.1f}%)'.format(name, format_bytes(num), 100*num/total))
+        if self.obs_store is not None:
+            # pool is sized for shared observations, without them fewer episodes fit
+            episode_rows = config.max_steps+1
+            print('observation pool: {} rows, at least {} of {} slots, all of them with {:.1f}% of observations shared'.format(
+                self.obs_pool.shape[0], self.obs_pool.shape[0]//episode_rows, self.capacity,
+                100*max(1-self.obs_pool.shape[0]/(episode_rows*self.capacity), 0)))
+
+    def new_array(self, name:str, shape, dtype):
+        if self.shared is None:
+            return np.zeros(shape, dtype=dtype)
+        return self.shared.create(name, shape, dtype)
+
+    def shared_specs(self):
+        return self.shared.specs
+
+    def set_resources(self, cores:List[int], threads:int):
+        resources.apply(cores, threads)
+
     def run(self):
+        if config.num_samplers > 0:
+            # batches are assembled by BatchSampler processes
+            return
         self.background_thread = threading.Thread(target=self.prepare_data, daemon=True)
         self.background_thread.start()
 
     def prepare_data(self):
         while True:
-            if len(self.data) <= 4:
+            if len(self.data) <= 4 and self.rate_limiter.can_sample(config.batch_size):
                 data = self.sample_batch(config.batch_size)
-                data_id = ray.put(data)
+                data_id = runtime.put(data)
                 self.data.append(data_id)
+                self.metrics.set('prepared_batches', len(self.data))
             else:
                 time.sleep(0.1)
     
     def get_data(self):
-
+        '''prepared batch, None if sampling is paused by the rate limiter'''
         if len(self.data) == 0:
+            if config.num_samplers > 0 or not self.rate_limiter.can_sample(config.batch_size):
+                return None
             print('no prepared data')
             data = self.sample_batch(config.batch_size)
-            data_id = ray.put(data)
+            data_id = runtime.put(data)
             return data_id
         else:
             return self.data.pop(0)
 
 
-    def add(self, data:Tuple):
-        # actor_id 0, num_agents 1, map_len 2, obs_buf 3, act_buf 4, rew_buf 5, hid_buf 6, cell_buf 7, td_errors 8, done 9, size 10
-        if data[0] >= 12:
-            stat_key = (data[1], data[2])
+    def sample_indices(self, batch_size:int):
+        '''indices for a batch sampler, None if enough batches are prepared or sampling is paused'''
+        if len(self.data) > 4 or not self.rate_limiter.can_sample(batch_size):
+            return None
 
-            if stat_key in self.stat_dict:
-                if len(self.stat_dict[stat_key]) < 200:
-                    self.stat_dict[stat_key].append(data[9])
-                else:
-                    self.stat_dict[stat_key].pop(0)
-                    self.stat_dict[stat_key].append(data[9])
+        with self.metrics.timer('sample_indices'), self.metrics.timed_lock(self.lock):
+            idxes, weights = self.sample_idxes(batch_size)
+            versions = self.slot_version[idxes // config.local_buffer_size]
+            return idxes, weights, self.ptr, versions
 
-        with self.lock:
+    def push_batch(self, data_ids:List):
+        '''batch from a sampler, ref is wrapped in a list so ray does not resolve it'''
+        self.data.append(data_ids[0])
+        self.metrics.set('prepared_batches', len(self.data))
+
+    def add(self, data:Tuple, record_curriculum:bool=False):
+        '''return whether the actor can keep adding and the curriculum version'''
+        with self.metrics.timer('add'):
+            self._add(data, record_curriculum)
+        return self.rate_limiter.can_insert(), self.curriculum.version
+
+    def can_insert(self):
+        return self.rate_limiter.can_insert()
+
+    def _add(self, data:Tuple, record_curriculum:bool=False):
+        # actor_id 0, num_agents 1, map_len 2, obs_buf 3, act_buf 4, rew_buf 5, hid_buf 6, td_errors 7, done 8, size 9
+        with self.metrics.timed_lock(self.lock):
+            if record_curriculum:
+                self.curriculum.record(data[1], data[2], data[8])
+
+            self.slot_version[self.ptr] += 1
             idxes = np.arange(self.ptr*config.local_buffer_size, (self.ptr+1)*config.local_buffer_size)
             start_idx = self.ptr*config.max_steps
             # update buffer size
             self.size -= self.size_buf[self.ptr].item()
-            self.size += data[10]
-            self.counter += data[10]
-
-            self.priority_tree.batch_update(idxes, data[8]**self.alpha)
-
-            self.obs_buf[start_idx+self.ptr:start_idx+self.ptr+data[10]+1] = data[3]
-            self.act_buf[start_idx:start_idx+data[10]] = data[4]
-            self.rew_buf[start_idx:start_idx+data[10]] = data[5]
-            self.hid_buf[start_idx:start_idx+data[10]] = data[6]
-            self.cell_buf[start_idx:start_idx+data[10]] = data[7]
-            self.done_buf[self.ptr] = data[9]
-            self.size_buf[self.ptr] = data[10]
+            self.size += data[9]
+            self.counter += data[9]
+            self.rate_limiter.insert(data[9])
+
+            self.target_version_buf[idxes] = -1
+            self.priority_tree.batch_update(idxes, data[7]**self.alpha)
+
+            if self.obs_store is not None:
+                self.release_obs(self.ptr)
+                # oldest episodes leave early while the pool lacks rows for this one
+                slot = self.ptr
+                while self.obs_store.num_free() < data[9]+1:
+                    slot = (slot+1) % self.capacity
+                    self.evict_slot(slot)
+                self.obs_buf[start_idx+self.ptr:start_idx+self.ptr+data[9]+1] = self.obs_store.add(data[3])
+            else:
+                self.obs_buf[start_idx+self.ptr:start_idx+self.ptr+data[9]+1] = data[3]
+            self.act_buf[start_idx:start_idx+data[9]] = data[4]
+            self.rew_buf[start_idx:start_idx+data[9]] = data[5]
+            self.hidden_store.add(self.ptr, data[6])
+            self.done_buf[self.ptr] = data[8]
+            self.size_buf[self.ptr] = data[9]
+            self.dirty_slots.add(self.ptr)
+            self.slot_version[self.ptr] += 1
 
             self.ptr = (self.ptr+1) % self.capacity
 
-    def sample_batch(self, batch_size:int) -> Tuple:
-
-        b_obs, b_action, b_reward, b_done, b_steps, b_bt_steps, = [], [], [], [], [], []
-        idxes, priorities = [], []
-        b_hidden, b_cell = [], []
+            if self.size >= config.learning_starts:
+                self.ready_event.set()
+
+    def release_obs(self, slot:int):
+        '''release pool rows of the episode in slot, lock must be held'''
+        if self.size_buf[slot] > 0:
+            start_idx = slot*(config.max_steps+1)
+            self.obs_store.release(self.obs_buf[start_idx:start_idx+self.size_buf[slot].item()+1])
+
+    def evict_slot(self, slot:int):
+        '''drop the episode in slot before it is overwritten, lock must be held'''
+        if self.size_buf[slot] == 0:
+            return
+        # odd while the slot is emptied like in _add, so batch samplers drop its samples
+        self.slot_version[slot] += 1
+        idxes = np.arange(slot*config.local_buffer_size, (slot+1)*config.local_buffer_size)
+        self.priority_tree.batch_update(idxes, np.zeros(config.local_buffer_size))
+        self.release_obs(slot)
+        self.size -= self.size_buf[slot].item()
+        self.size_buf[slot] = 0
+        self.dirty_slots.add(slot)
+        self.slot_version[slot] += 1
+        self.evicted += 1
+
+    def snapshot_arrays(self):
+        '''
+        arrays to snapshot, with number of rows per episode slot, None to write whole array
+        and 'pool' to write rows changed in the observation pool
+        '''
+        pool_arrays = {
+            'obs_pool': (self.obs_pool, 'pool'),
+            'obs_refcount': (self.obs_store.refcount, 'pool'),
+        } if self.obs_store is not None else {}
+        return {
+            **pool_arrays,
+            'obs_buf': (self.obs_buf, config.max_steps+1),
+            'act_buf': (self.act_buf, config.max_steps),
+            'rew_buf': (self.rew_buf, config.max_steps),
+            'hid_buf': (self.hidden_store.buf, self.hidden_store.slot_len),
+            'done_buf': (self.done_buf, 1),
+            'size_buf': (self.size_buf, 1),
+            'priority_tree': (self.priority_tree.tree, None),
+        }
+
+    def open_snapshot(self, path:str, create:bool):
+        self.snapshot_files = {}
+        for name, (array, _) in self.snapshot_arrays().items():
+            file = os.path.join(path, name+'.npy')
+            if create:
+                self.snapshot_files[name] = np.lib.format.open_memmap(file, mode='w+', dtype=array.dtype, shape=array.shape)
+            else:
+                self.snapshot_files[name] = np.lib.format.open_memmap(file, mode='r+')
+                assert self.snapshot_files[name].shape == array.shape and self.snapshot_files[name].dtype == array.dtype, \
+                    'snapshot {} does not match buffer'.format(name)
+        self.snapshot_path = path
+
+    def snapshot(self, path:str=config.buffer_snapshot_path):
+        '''write slots added since last snapshot to memory-mapped files, skipped while another snapshot runs'''
+        # calls are not awaited by train.py and the buffer serves two threads
+        if not self.snapshot_lock.acquire(blocking=False):
+            print('buffer snapshot: previous one is still running, skipped')
+            return
+        try:
+            self.write_snapshot(path)
+        finally:
+            self.snapshot_lock.release()
+
+    def write_snapshot(self, path:str):
+        # restore only trusts arrays while a meta file exists, so it is removed before they change
+        meta_path = os.path.join(path, 'meta.pkl')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        if self.snapshot_files is None or self.snapshot_path != path:
+            os.makedirs(path, exist_ok=True)
+            self.open_snapshot(path, create=True)
+            with self.lock:
+                self.dirty_slots = set(range(self.capacity))
+                if self.obs_store is not None:
+                    self.obs_store.dirty[:] = True
+
+        # copy a chunk of slots at a time under lock and write it to disk outside of it, the last
+        # chunk also copies whole arrays and meta together with slots written in the meantime
+        num_slots = 0
+        final = False
+        try:
+            while not final:
+                chunks = []
+                with self.lock:
+                    final = len(self.dirty_slots) <= config.buffer_snapshot_chunk
+                    slots = sorted(self.dirty_slots)[:config.buffer_snapshot_chunk]
+                    self.dirty_slots.difference_update(slots)
+                    if final and self.obs_store is not None:
+                        pool_rows = self.obs_store.take_dirty()
+                    for name, (array, slot_len) in self.snapshot_arrays().items():
+                        if slot_len is None:
+                            if final:
+                                chunks.append((name, slice(None), np.copy(array)))
+                        elif slot_len == 'pool':
+                            if final:
+                                chunks.append((name, pool_rows, array[pool_rows]))
+                        else:
+                            for slot in slots:
+                                rows = slice(slot*slot_len, (slot+1)*slot_len)
+                                chunks.append((name, rows, np.copy(array[rows])))
+
+                    if final:
+                        meta = {'ptr': self.ptr, 'size': self.size, 'stat_dict': self.curriculum.state()}
+
+                for name, rows, chunk in chunks:
+                    self.snapshot_files[name][rows] = chunk
+                num_slots += len(slots)
+        except BaseException:
+            # slots taken out of dirty_slots may be missing, write all of them next time
+            self.snapshot_files = None
+            raise
+
+        for mm in self.snapshot_files.values():
+            mm.flush()
+
+        with open(meta_path+'.tmp', 'wb') as f:
+            pickle.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(meta_path+'.tmp', meta_path)
+        dir_fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        print('buffer snapshot: {} slots'.format(num_slots))
+
+    def restore(self, path:str=config.buffer_snapshot_path):
+        '''load buffer from snapshot, return buffer size'''
+        if not os.path.exists(os.path.join(path, 'meta.pkl')):
+            print('no buffer snapshot in {}'.format(path))
+            return self.size
+
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+            meta = pickle.load(f)
 
         with self.lock:
+            self.open_snapshot(path, create=False)
+            for name, (array, _) in self.snapshot_arrays().items():
+                array[:] = self.snapshot_files[name]
+
+            self.ptr = meta['ptr']
+            self.size = meta['size']
+            self.curriculum.load_state(meta['stat_dict'])
+            if self.obs_store is not None:
+                self.obs_store.rebuild()
+            # restored transitions count towards learning starts but are not owed to the learner
+            self.rate_limiter.inserted = min(self.size, self.rate_limiter.min_size)
+            self.dirty_slots = set()
+            if self.size >= config.learning_starts:
+                self.ready_event.set()
+
+        print('buffer restored: {} transitions'.format(self.size))
+        return self.size
 
-            idxes, priorities = self.priority_tree.batch_sample(batch_size)
-            global_idxes = idxes // config.local_buffer_size
-            local_idxes = idxes % config.local_buffer_size
-
-            for idx, global_idx, local_idx in zip(idxes.tolist(), global_idxes.tolist(), local_idxes.tolist()):
-                
-                assert local_idx < self.size_buf[global_idx]
-
-                steps = int(min(config.forward_steps, (self.size_buf[global_idx]-local_idx).item()))
-                bt_steps = min(local_idx+1, config.bt_steps)
-                # print(idx+global_idx-bt_steps+1)
-                # print(idx+global_idx+1+steps)
-                obs = self.obs_buf[idx+global_idx-bt_steps+1:idx+global_idx+1+steps]
-
-                if local_idx <= config.bt_steps-1:
-                    hidden = np.zeros(config.latent_dim, dtype=np.float32)
-                    cell = np.zeros(config.latent_dim, dtype=np.float32)
-                else:
-                    hidden = self.hid_buf[idx-config.bt_steps-1]
-                    cell = self.cell_buf[idx-config.bt_steps-1]
-                
-                if obs.shape[0] < config.bt_steps+config.forward_steps:
-                    pad_len = config.bt_steps+config.forward_steps-obs.shape[0]
-                    obs = np.pad(obs, ((0,pad_len),(0,0),(0,0),(0,0)))
-
-                action = self.act_buf[idx]
-                reward = 0
-                for i in range(steps):
-                    reward += self.rew_buf[idx+i]*0.99**i
-
-                if local_idx >= self.size_buf[global_idx]-config.forward_steps and self.done_buf[global_idx]:
-                    done = True
-                else:
-                    done = False
-                
-                b_obs.append(obs)
-                b_action.append(action)
-                b_reward.append(reward)
-
-                b_done.append(done)
-                b_steps.append(steps)
-                b_bt_steps.append(bt_steps)
-
-                b_hidden.append(hidden)
-                b_cell.append(cell)
-
-            # importance sampling weights
-            min_p = np.min(priorities)
-            weights = np.power(priorities/min_p, -self.beta)
-
-            data = (
-                torch.from_numpy(np.stack(b_obs).astype(np.float32)),
-                torch.LongTensor(b_action).unsqueeze(1),
-                torch.FloatTensor(b_reward).unsqueeze(1),
+    def sample_batch(self, batch_size:int) -> Tuple:
+        with self.metrics.timer('sample_batch'), self.metrics.timed_lock(self.lock):
+            idxes, weights = self.sample_idxes(batch_size)
+            return assemble_batch(self, idxes, weights, self.ptr)
 
-                torch.FloatTensor(b_done).unsqueeze(1),
-                torch.FloatTensor(b_steps).unsqueeze(1),
-                b_bt_steps,
-                (torch.from_numpy(np.stack(b_hidden)),
-                torch.from_numpy(np.stack(b_cell))),
+    def sample_idxes(self, batch_size:int):
+        '''prioritized sample with importance sampling weights, lock must be held'''
+        idxes, priorities = self.priority_tree.batch_sample(batch_size)
+        self.rate_limiter.sample(batch_size)
 
-                idxes,
-                torch.from_numpy(weights).unsqueeze(1),
-                self.ptr
-            )
+        # importance sampling weights
+        min_p = np.min(priorities)
+        weights = np.power(priorities/min_p, -self.beta)
 
-            return data
+        return idxes, weights
 
-    def update_priorities(self, idxes:np.ndarray, priorities:np.ndarray, old_ptr:int):
-        """Update priorities of sampled transitions"""
-        with self.lock:
+    def update_priorities(self, idxes:np.ndarray, priorities:np.ndarray, old_ptr:int,
+                        target_idxes:np.ndarray=None, target_q:np.ndarray=None, target_version:int=-1):
+        """Update priorities of sampled transitions, and target values computed by the learner"""
+        with self.metrics.timer('update_priorities'), self.metrics.timed_lock(self.lock):
 
             # discard the idx that already been discarded during training
-            if self.ptr > old_ptr:
-                # range from [old_ptr, self.ptr)
-                mask = (idxes < old_ptr*config.max_steps) | (idxes >= self.ptr*config.max_steps)
-                idxes = idxes[mask]
-                priorities = priorities[mask]
-            elif self.ptr < old_ptr:
-                # range from [0, self.ptr) & [old_ptr, self,capacity)
-                mask = (idxes < old_ptr*config.max_steps) & (idxes >= self.ptr*config.max_steps)
-                idxes = idxes[mask]
-                priorities = priorities[mask]
+            mask = self.valid_mask(idxes, old_ptr)
+            idxes = idxes[mask]
+            priorities = priorities[mask]
 
             self.priority_tree.batch_update(np.copy(idxes), np.copy(priorities)**self.alpha)
 
+            if target_idxes is not None:
+                mask = self.valid_mask(target_idxes, old_ptr)
+                self.target_q_buf[target_idxes[mask]] = target_q[mask]
+                self.target_version_buf[target_idxes[mask]] = target_version
+
+    def valid_mask(self, idxes:np.ndarray, old_ptr:int):
+        """mask of idxes whose slots are not overwritten since old_ptr"""
+        if self.ptr > old_ptr:
+            # range from [old_ptr, self.ptr)
+            mask = (idxes < old_ptr*config.max_steps) | (idxes >= self.ptr*config.max_steps)
+        elif self.ptr < old_ptr:
+            # range from [0, self.ptr) & [old_ptr, self,capacity)
+            mask = (idxes < old_ptr*config.max_steps) & (idxes >= self.ptr*config.max_steps)
+        else:
+            mask = np.ones(idxes.shape[0], dtype=np.bool)
+
+        if self.obs_store is not None:
+            # slots evicted ahead of ptr
+            mask &= idxes % config.local_buffer_size < self.size_buf[idxes // config.local_buffer_size]
+        return mask
+
     def stats(self, interval:int):
         print('buffer update speed: {}/s'.format(self.counter/interval))
         print('buffer size: {}'.format(self.size))
+        if self.rate_limiter.samples_per_insert is not None:
+            print('samples per insert: {:.2f} (target {})'.format(self.rate_limiter.ratio(), self.rate_limiter.samples_per_insert))
 
-        for key, val in self.stat_dict.copy().items():
-            print('{}: {}/{}'.format(key, sum(val), len(val)))
-            if len(val) == 200 and sum(val) >= 200*config.pass_rate:
-                # add number of agents
-                add_agent_key = (key[0]+1, key[1]) 
-                if add_agent_key[0] <= config.max_num_agetns and add_agent_key not in self.stat_dict:
-                    self.stat_dict[add_agent_key] = []
-                
-                if key[1] < config.max_map_lenght:
-                    add_map_key = (key[0], key[1]+5) 
-                    if add_map_key not in self.stat_dict:
-                        self.stat_dict[add_map_key] = []
-                
-                    del self.stat_dict[key]
+        if self.obs_store is not None:
+            print('observation dedup: {:.1f}% of observations shared, pool {}/{} rows, {}/{} slots held, {} episodes evicted'.format(
+                100*self.obs_store.dedup_rate(), self.obs_pool.shape[0]-self.obs_store.num_free(), self.obs_pool.shape[0],
+                np.count_nonzero(self.size_buf), self.capacity, self.evicted))
 
-        self.level = ray.put(list(self.stat_dict.keys()))
+        # curriculum is also read and recorded by the other thread
+        with self.lock:
+            self.curriculum.summary()
+            self.curriculum.update()
 
         self.counter = 0
 
+    def report_metrics(self, source:str, snapshot:dict):
+        self.actor_metrics[source] = snapshot
+
+    def get_metrics(self):
+        self.metrics.set('size', self.size)
+        usage = self.memory_usage()
+        self.metrics.set('memory_bytes', sum(usage.values()))
+        for name, num in usage.items():
+            self.metrics.set('memory_bytes_{}'.format(name), num)
+        self.metrics.set('prepared_batches', len(self.data))
+        if self.rate_limiter.samples_per_insert is not None:
+            self.metrics.set('samples_per_insert', self.rate_limiter.ratio())
+            self.metrics.set('rate_limiter_diff', self.rate_limiter.diff())
+        if self.obs_store is not None:
+            self.metrics.set('obs_dedup_rate', self.obs_store.dedup_rate())
+            self.metrics.set('obs_pool_rows', self.obs_pool.shape[0]-self.obs_store.num_free())
+            self.metrics.set('evicted_episodes', self.evicted)
+        return {'buffer': self.metrics.snapshot(), **self.actor_metrics}
+
     def ready(self):
         if len(self) >= config.learning_starts:
             return True
         else:
             return False
+
+    def wait_ready(self, timeout:float):
+        '''block until learning starts or timeout, return ready'''
+        return self.ready_event.wait(timeout)
     
     def get_level(self):
-        return self.level
+        '''curriculum version and its levels'''
+        with self.lock:
+            return self.curriculum.version, self.curriculum.level_list()
 
     def check_done(self):
+        with self.lock:
+            return self.curriculum.done()
 
-        for i in range(config.max_num_agetns):
-            if (i+1, config.max_map_lenght) not in self.stat_dict:
-                return False
-        
-            l = self.stat_dict[(i+1, config.max_map_lenght)]
-            
-            if len(l) < 200:
-                return False
-            elif sum(l) < 200*config.pass_rate:
-                return False
-            
-        return True
-
-@ray.remote(num_cpus=1, num_gpus=1)
+@runtime.remote(num_cpus=1)
+class BatchSampler:
+    def __init__(self, sampler_id:int, buffer:GlobalBuffer, specs:dict):
+        '''assemble batches from replay arrays of buffer in shared memory, buffer only samples indices'''
+        self.id = sampler_id
+        self.buffer = buffer
+        self.shared = SharedArrays.attach(specs)
+        arrays = dict(self.shared.arrays)
+
+        self.hidden_store = HiddenStore(1)
+        self.hidden_store.buf = arrays.pop('hid_buf')
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        self.metrics = Metrics('sampler')
+
+    def set_resources(self, cores:List[int], threads:int):
+        resources.apply(cores, threads)
+
+    def run(self):
+        counter = 0
+        while True:
+            indices = runtime.get(self.buffer.sample_indices.remote(config.batch_size))
+            if indices is None:
+                time.sleep(0.01)
+                continue
+
+            idxes, weights, ptr, versions = indices
+            with self.metrics.timer('assemble_batch'):
+                data = assemble_batch(self, idxes, weights, ptr, versions)
+            self.buffer.push_batch.remote([runtime.put(data)])
+
+            counter += 1
+            if counter % 100 == 0:
+                self.buffer.report_metrics.remote('sampler{}'.format(self.id), self.metrics.snapshot())
+
+
+@runtime.remote(num_cpus=1, num_gpus=1)
 class Learner:
-    def __init__(self, buffer:GlobalBuffer):
+    def __init__(self, buffer:GlobalBuffer, rank:int=0, world_size:int=1):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model = Network()
+        self.rank = rank
+        self.world_size = world_size
+        self.model = Network(cnn_channel=config.cnn_channel)
         self.model.to(self.device)
         self.tar_model = deepcopy(self.model)
         self.optimizer = Adam(self.model.parameters(), lr=1e-4)
@@ -251,89 +696,261 @@ class Learner:
         self.buffer = buffer
         self.counter = 0
         self.last_counter = 0
+        # increased on every target network update, tags target values cached in buffer
+        self.target_version = 0
         self.done = False
         self.loss = 0
+        self.metrics = Metrics('learner')
         taus = torch.arange(0, 200+1, device=self.device, dtype=torch.float32) / 200
         taus = ((taus[1:] + taus[:-1]) / 2.0).view(1, 200, 1)
         self.taus = taus.expand(config.batch_size, 200, 200)
 
-        self.store_weights()
+        if config.load_model is not None:
+            self.load_checkpoint(config.load_model)
+        self.checkpoint_writer = CheckpointWriter() if rank == 0 else None
+
+        if world_size > 1:
+            dist.init_process_group('gloo', init_method=config.learner_dist_url, rank=rank, world_size=world_size)
+            for param in self.model.parameters():
+                dist.broadcast(param.data, 0)
+            self.tar_model.load_state_dict(self.model.state_dict())
+
+        if rank == 0:
+            self.store_weights()
 
     def get_weights(self):
         return self.weights_id
 
+    def get_weights_version(self):
+        '''number of updates of the published weights and their object ref'''
+        return self.weights_counter, self.weights_id
+
     def store_weights(self):
+        with self.phase('store_weights'):
+            self._store_weights()
+
+    def _store_weights(self):
         state_dict = self.model.state_dict()
         for k, v in state_dict.items():
-            state_dict[k] = v.cpu()
-        self.weights_id = ray.put(state_dict)
+            # copy so that a shared memory transfer never aliases live parameters
+            state_dict[k] = v.cpu().clone()
+        self.weights_id = runtime.put(state_dict)
+        self.weights_counter = self.counter
+
+    def save_checkpoint(self):
+        '''snapshot full training state, written by the checkpoint writer thread'''
+        with self.phase('checkpoint_snapshot'):
+            state = snapshot({
+                'arch': self.model.arch,
+                'model': self.model.state_dict(),
+                'tar_model': self.tar_model.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict(),
+                'counter': self.counter,
+                'target_version': self.target_version,
+            })
+        self.checkpoint_writer.submit(self.counter, state)
+
+    def save_best(self, counter:int, state_dict:dict, result:dict):
+        '''weights of counter updates with the best evaluation result so far'''
+        self.checkpoint_writer.submit_best(counter, {'arch': self.model.arch, 'state_dict': state_dict}, result)
+
+    def load_checkpoint(self, path:str):
+        if path == 'latest':
+            path = latest_checkpoint(config.save_path)
+            if path is None:
+                raise RuntimeError('no checkpoint in index of {}'.format(config.save_path))
+        checkpoint = load_checkpoint(path, self.device)
+        if 'model' not in checkpoint:
+            # model only state dict
+            self.model.load_state_dict(checkpoint)
+            self.tar_model.load_state_dict(checkpoint)
+        else:
+            self.model.load_state_dict(checkpoint['model'])
+            self.tar_model.load_state_dict(checkpoint['tar_model'])
+            self.optimizer.load_state_dict(checkpoint['optimizer'])
+            self.scheduler.load_state_dict(checkpoint['scheduler'])
+            self.counter = checkpoint['counter']
+            self.last_counter = self.counter
+            self.target_version = checkpoint.get('target_version', 0)
+        print('load model from {}'.format(path))
+
+    def set_resources(self, cores:List[int], threads:int):
+        resources.apply(cores, threads)
 
     def run(self):
         self.learning_thread = threading.Thread(target=self.train, daemon=True)
         self.learning_thread.start()
 
+    def check_done(self):
+        '''rank 0 decides so that all learners leave the training loop together'''
+        done = torch.zeros(1, dtype=torch.uint8)
+        if self.rank == 0:
+            done[0] = runtime.get(self.buffer.check_done.remote())
+        if self.world_size > 1:
+            dist.broadcast(done, 0)
+        return bool(done.item())
+
+    def all_reduce_gradients(self):
+        grads = [ param.grad for param in self.model.parameters() ]
+        flat_grads = torch.cat([ grad.view(-1) for grad in grads ])
+        dist.all_reduce(flat_grads)
+        flat_grads /= self.world_size
+
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat_grads[offset:offset+grad.numel()].view_as(grad))
+            offset += grad.numel()
+
     def train(self):
-        batch_idx = torch.arange(config.batch_size)
+        profiler = None
 
-        while not ray.get(self.buffer.check_done.remote()):
+        while not self.check_done():
             for i in range(1, 10001):
 
-                data_id = ray.get(self.buffer.get_data.remote())
-                data = ray.get(data_id)
-    
-                b_obs, b_action, b_reward, b_done, b_steps, b_bt_steps, b_hidden, idxes, weights, old_ptr = data
-                b_obs, b_action, b_reward = b_obs.to(self.device), b_action.to(self.device), b_reward.to(self.device)
-                b_done, b_steps, weights = b_done.to(self.device), b_steps.to(self.device), weights.to(self.device)
-                b_hidden = (b_hidden[0].to(self.device), b_hidden[1].to(self.device))
-
-                b_next_bt_steps = [ bt_steps+steps.item() for bt_steps, steps in zip(b_bt_steps, b_steps) ]
-
-                with torch.no_grad():
-                    # choose max q index from next observation
-                    # double q-learning
-                    if config.double_q:
-                        b_action_ = self.model.bootstrap(b_obs, b_next_bt_steps, b_hidden).argmax(1, keepdim=True)
-                        b_q_ = (1 - b_done) * self.tar_model.bootstrap(b_obs, b_next_bt_steps, b_hidden).gather(1, b_action_)
-                    else:
-                        b_q_ = (1 - b_done) * self.tar_model.bootstrap(b_obs, b_next_bt_steps, b_hidden).max(1, keepdim=True)[0]
-
-                b_q = self.model.bootstrap(b_obs[:, :-config.forward_steps], b_bt_steps, b_hidden).gather(1, b_action)
-
-                td_error = (b_q - (b_reward + (0.99 ** b_steps) * b_q_))
-
-                priorities = td_error.detach().squeeze().abs().cpu().clamp(1e-6).numpy()
+                if config.profile_window is not None and self.counter == config.profile_window[0]:
+                    profiler = self.start_profiler()
 
-                loss = (weights * self.huber_loss(td_error)).mean()
+                with self.phase('data_fetch'):
+                    data_id = runtime.get(self.buffer.get_data.remote())
+                    # paused by rate limiter until actors catch up
+                    while data_id is None:
+                        time.sleep(0.01)
+                        data_id = runtime.get(self.buffer.get_data.remote())
+                    data = runtime.get(data_id)
 
-                self.optimizer.zero_grad()
-
-                loss.backward()
-                self.loss = loss.item()
-
-
-                nn.utils.clip_grad_norm_(self.model.parameters(), 40)
-
-                self.optimizer.step()
- 
-                self.scheduler.step()
+                idxes, priorities, old_ptr, target_idxes, target_q = self.learn(data)
 
                 # store new weights in shared memory
-                if i % 5  == 0:
+                if self.rank == 0 and i % 5  == 0:
                     self.store_weights()
 
-                self.buffer.update_priorities.remote(idxes, priorities, old_ptr)
+                with self.phase('priority_update'):
+                    if target_idxes is not None:
+                        self.buffer.update_priorities.remote(idxes, priorities, old_ptr, target_idxes, target_q, self.target_version)
+                    else:
+                        self.buffer.update_priorities.remote(idxes, priorities, old_ptr)
 
                 self.counter += 1
 
+                if profiler is not None:
+                    profiler.step()
+                    if self.counter == config.profile_window[1]:
+                        self.stop_profiler(profiler)
+                        profiler = None
+
                 # update target net, save model
                 if i % config.target_network_update_freq == 0:
                     self.tar_model.load_state_dict(self.model.state_dict())
+                    self.target_version += 1
                 
-                if i % config.save_interval == 0:
-                    torch.save(self.model.state_dict(), os.path.join(config.save_path, '{}.pth'.format(self.counter)))
+                if self.rank == 0 and i % config.save_interval == 0:
+                    self.save_checkpoint()
                 
 
+        if self.rank == 0:
+            self.checkpoint_writer.close()
         self.done = True
+
+    def learn(self, data:Tuple):
+        '''
+        one update on a batch of GlobalBuffer.sample_batch, return idxes, priorities and ptr for update_priorities,
+        with target cache also idxes and values of recomputed targets (None otherwise)
+        '''
+        b_obs, b_action, b_reward, b_done, b_steps, b_bt_steps, b_hidden, b_target_q, b_target_version, idxes, weights, old_ptr = data
+        target_idxes, target_q = None, None
+
+        with self.phase('device_transfer'):
+            b_obs, b_action, b_reward = b_obs.to(self.device), b_action.to(self.device), b_reward.to(self.device)
+            b_done, b_steps, weights = b_done.to(self.device), b_steps.to(self.device), weights.to(self.device)
+            b_hidden = b_hidden.to(self.device)
+
+        b_next_bt_steps = [ bt_steps+steps.item() for bt_steps, steps in zip(b_bt_steps, b_steps) ]
+
+        with self.phase('target_forward'), torch.no_grad():
+            # choose max q index from next observation
+            # double q-learning
+            if config.double_q:
+                b_action_ = self.model.bootstrap(b_obs, b_next_bt_steps, b_hidden).argmax(1, keepdim=True)
+                b_q_ = (1 - b_done) * self.tar_model.bootstrap(b_obs, b_next_bt_steps, b_hidden).gather(1, b_action_)
+            elif config.cache_target_q:
+                b_q_, target_idxes, target_q = self.cached_target(b_obs, b_next_bt_steps, b_hidden, b_done,
+                                                                b_target_q, b_target_version, idxes)
+            else:
+                b_q_ = (1 - b_done) * self.tar_model.bootstrap(b_obs, b_next_bt_steps, b_hidden).max(1, keepdim=True)[0]
+
+        with self.phase('online_forward'):
+            b_q = self.model.bootstrap(b_obs[:, :-config.forward_steps], b_bt_steps, b_hidden).gather(1, b_action)
+
+        with self.phase('loss'):
+            td_error = (b_q - (b_reward + (0.99 ** b_steps) * b_q_))
+
+            priorities = td_error.detach().squeeze().abs().cpu().clamp(1e-6).numpy()
+
+            loss = (weights * self.huber_loss(td_error)).mean()
+
+        with self.phase('backward'):
+            self.optimizer.zero_grad()
+
+            loss.backward()
+            self.loss = loss.item()
+
+        if self.world_size > 1:
+            with self.phase('all_reduce'):
+                self.all_reduce_gradients()
+
+        with self.phase('clip_grad'):
+            nn.utils.clip_grad_norm_(self.model.parameters(), 40)
+
+        with self.phase('optimizer_step'):
+            self.optimizer.step()
+
+            self.scheduler.step()
+
+        return idxes, priorities, old_ptr, target_idxes, target_q
+
+    @contextmanager
+    def phase(self, name:str):
+        '''stage timer, also labeled in profiler traces'''
+        with self.metrics.timer(name), torch.profiler.record_function(name):
+            yield
+
+    def start_profiler(self):
+        activities = [ torch.profiler.ProfilerActivity.CPU ]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        profiler.start()
+        return profiler
+
+    def stop_profiler(self, profiler):
+        profiler.stop()
+        os.makedirs(config.profile_path, exist_ok=True)
+        path = os.path.join(config.profile_path, 'learner{}_{}.json'.format(self.rank, self.counter))
+        profiler.export_chrome_trace(path)
+        print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+        print('profiler trace saved to {}'.format(path))
+
+    def cached_target(self, b_obs, b_next_bt_steps, b_hidden, b_done, b_target_q, b_target_version, idxes):
+        '''
+        target values from buffer cache, only transitions cached with an older target network are
+        bootstrapped, return target values and the recomputed ones to store back in buffer
+        '''
+        stale = np.flatnonzero(b_target_version != self.target_version)
+        self.metrics.set('target_cache_hit', 1-stale.shape[0]/b_target_version.shape[0])
+
+        b_q_ = b_target_q.to(self.device)
+        if stale.shape[0] == 0:
+            return b_q_, idxes[stale], np.zeros(0, dtype=np.float32)
+
+        stale_idx = torch.from_numpy(stale).to(self.device)
+        # batch is sorted by sequence length, so is any subset
+        target_q = (1 - b_done[stale_idx]) * self.tar_model.bootstrap(b_obs[stale_idx], [ b_next_bt_steps[i] for i in stale ],
+                                                                        b_hidden[stale_idx]).max(1, keepdim=True)[0]
+        b_q_[stale_idx] = target_q
+
+        return b_q_, idxes[stale], target_q.squeeze(1).cpu().numpy()
+
     def huber_loss(self, td_error, kappa=1.0):
         abs_td_error = td_error.abs()
         flag = (abs_td_error < kappa).float()
@@ -347,12 +964,104 @@ class Learner:
         self.last_counter = self.counter
         return self.done
 
+    def get_metrics(self):
+        self.metrics.set('updates', self.counter)
+        return {'learner{}'.format(self.rank): self.metrics.snapshot()}
+
+
+@runtime.remote(num_cpus=1)
+class Evaluator:
+    def __init__(self, learner:Learner):
+        '''greedy evaluation of the latest published weights every eval_interval learner updates'''
+        self.learner = learner
+        self.model = Network(cnn_channel=config.cnn_channel)
+        self.model.eval()
+        if config.encoder_cache_size is not None:
+            self.model.enable_encoder_cache(config.encoder_cache_size)
+        self.last_counter = None
+        # mean success rate and mean steps over suites of the best weights so far
+        self.best = None
+        self.metrics = Metrics('evaluator')
+
+        self.tests = dict()
+        for test_case in config.eval_tests:
+            if not os.path.exists(test_case):
+                print('evaluation suite {} not found'.format(test_case))
+                continue
+            with open(test_case, 'rb') as f:
+                self.tests[os.path.splitext(os.path.basename(test_case))[0]] = pickle.load(f)
+
+    def set_resources(self, cores:List[int], threads:int):
+        resources.apply(cores, threads)
+
+    def run(self):
+        self.eval_thread = threading.Thread(target=self.evaluate_loop, daemon=True)
+        self.eval_thread.start()
+
+    def evaluate_loop(self):
+        while True:
+            counter, weights_id = runtime.get(self.learner.get_weights_version.remote())
+            if self.last_counter is None:
+                # first evaluation eval_interval updates after start, not of the initial weights
+                self.last_counter = counter
+            if counter-self.last_counter < config.eval_interval:
+                time.sleep(1)
+                continue
+
+            self.last_counter = counter
+            self.model.load_state_dict(runtime.get(weights_id))
+            self.evaluate(counter)
+
+    def evaluate(self, counter:int):
+        record = {'updates': counter, 'time': time.time()}
+        for name, tests in self.tests.items():
+            with self.metrics.timer('evaluate'):
+                result = evaluate_batched(self.model, tests)
+            record[name] = result
+            self.metrics.set('{}_success_rate'.format(name), result['success_rate'])
+            self.metrics.set('{}_mean_steps'.format(name), result['mean_steps'])
+        self.metrics.set('updates', counter)
+        if self.model.encoder_cache is not None:
+            # rate is computed from the sums over processes by MetricsExporter
+            self.metrics.count('encoder_cache_hits', self.model.encoder_cache.hits)
+            self.metrics.count('encoder_cache_lookups', self.model.encoder_cache.lookups)
+
+        with open(config.eval_log_path, 'a') as f:
+            f.write(json.dumps(record)+'\n')
+
+        if not self.tests:
+            return
+        success_rate = sum(record[name]['success_rate'] for name in self.tests) / len(self.tests)
+        mean_steps = sum(record[name]['mean_steps'] for name in self.tests) / len(self.tests)
+        # higher success rate first, fewer steps on ties
+        if self.best is None or (success_rate, -mean_steps) > (self.best[0], -self.best[1]):
+            self.best = (success_rate, mean_steps)
+            self.learner.save_best.remote(counter, snapshot(self.model.state_dict()), {'success_rate': success_rate, 'mean_steps': mean_steps})
+            print('evaluation: new best weights at {} updates, success rate {:.4f}, mean steps {:.2f}'.format(counter, success_rate, mean_steps))
+
+    def get_metrics(self):
+        return {'evaluator': self.metrics.snapshot()}
+
+
+class EnvGroup:
+    '''environment of a double-buffered actor with its own recurrent state'''
+    __slots__ = ('env', 'obs', 'hidden', 'local_buffer')
+    def __init__(self):
+        self.env = Environment(adaptive=True)
+        self.obs = None
+        self.hidden = None
+        self.local_buffer = None
 
-@ray.remote(num_cpus=1)
+
+@runtime.remote(num_cpus=1)
 class Actor:
-    def __init__(self, worker_id, epsilon, learner:Learner, buffer:GlobalBuffer):
+    def __init__(self, worker_id, epsilon, learner:Learner, buffer:GlobalBuffer, record_curriculum:bool=False):
         self.id = worker_id
+        # episodes of low epsilon actors measure the pass rate of curriculum levels
+        self.record_curriculum = record_curriculum
         self.model = Network()
+        if config.encoder_cache_size is not None:
+            self.model.enable_encoder_cache(config.encoder_cache_size)
         self.model.eval()
         self.env = Environment(adaptive=True)
         self.epsilon = epsilon
@@ -360,9 +1069,22 @@ class Actor:
         self.global_buffer = buffer
         self.max_steps = config.max_steps
         self.counter = 0
+        self.metrics = Metrics('actor')
+        # global buffer add calls not yet finished
+        self.inflight_adds = []
+        # cached curriculum levels, fetched again once an add reports a newer version
+        self.levels = None
+        self.level_version = -1
+        self.latest_level_version = 0
+
+    def set_resources(self, cores:List[int], threads:int):
+        resources.apply(cores, threads)
 
     def run(self):
         """ Generate training batch sample """
+        if config.actor_env_groups > 1:
+            return self.run_groups(config.actor_env_groups)
+
         done = False
 
         obs, local_buffer = self.reset()
@@ -371,17 +1093,19 @@ class Actor:
 
             # sample action
             # Note: q_val is quantile values if it's distributional
-            actions, q_val, hidden = self.model.step(torch.from_numpy(obs.astype(np.float32)))
+            with self.metrics.timer('inference'):
+                actions, q_val, hidden = self.model.step(torch.from_numpy(obs.astype(np.float32)))
 
             if random.random() < self.epsilon:
                 # Note: only one agent can do random action in order to make the whole environment more stable
                 actions[0] = np.random.randint(0, 5)
 
             # take action in env
-            next_obs, r, done, _ = self.env.step(actions)
+            with self.metrics.timer('env_step'):
+                next_obs, r, done, _ = self.env.step(actions)
 
             # return data and update observation
-            local_buffer.add(q_val[0], actions[0], r[0], next_obs[0], (hidden[0][0], hidden[1][0]))
+            local_buffer.add(q_val[0], actions[0], r[0], next_obs[0], hidden[0])
 
             if done == False and self.env.steps < self.max_steps:
 
@@ -389,34 +1113,126 @@ class Actor:
             else:
                 # finish and send buffer
                 if done:
-                    data = local_buffer.finish()
+                    with self.metrics.timer('finish'):
+                        data = local_buffer.finish()
                 else:
 
                     _, q_val, _ = self.model.step(torch.from_numpy(obs.astype(np.float32)))
 
-                    data = local_buffer.finish(q_val[0])
+                    with self.metrics.timer('finish'):
+                        data = local_buffer.finish(q_val[0])
 
-                self.global_buffer.add.remote(data)
+                with self.metrics.timer('backpressure'):
+                    self.send(data)
 
                 done = False
 
-                obs, local_buffer = self.reset()
+                with self.metrics.timer('reset'):
+                    obs, local_buffer = self.reset()
 
             self.counter += 1
             if self.counter == config.actor_update_steps:
-                self.update_weights()
+                with self.metrics.timer('weight_fetch'):
+                    self.update_weights()
+                self.global_buffer.report_metrics.remote('actor{}'.format(self.id), self.metrics.snapshot())
                 self.counter = 0
 
+    def run_groups(self, num_groups:int):
+        '''
+        step environment groups in turn, inference of the next group runs on a worker thread
+        while the environment of the current group steps, torch releases the GIL during ops
+        '''
+        groups = [ EnvGroup() for _ in range(num_groups) ]
+        for group in groups:
+            self.reset_group(group)
+
+        executor = ThreadPoolExecutor(1)
+        future = executor.submit(self.infer, groups[0])
+
+        while True:
+            for i, group in enumerate(groups):
+                actions, q_val, hidden = future.result()
+
+                # no inference in flight, safe to load weights
+                self.counter += 1
+                if self.counter == config.actor_update_steps:
+                    with self.metrics.timer('weight_fetch'):
+                        self.update_weights()
+                    self.global_buffer.report_metrics.remote('actor{}'.format(self.id), self.metrics.snapshot())
+                    self.counter = 0
+
+                future = executor.submit(self.infer, groups[(i+1)%num_groups])
+
+                self.step_group(group, actions, q_val, hidden)
+
+    def infer(self, group:EnvGroup):
+        with self.metrics.timer('inference'):
+            return self.model.step_hidden(torch.from_numpy(group.obs.astype(np.float32)), group.hidden)
+
+    def step_group(self, group:EnvGroup, actions:List[int], q_val:np.ndarray, hidden:torch.Tensor):
+        if random.random() < self.epsilon:
+            actions[0] = np.random.randint(0, 5)
+
+        with self.metrics.timer('env_step'):
+            next_obs, r, done, _ = group.env.step(actions)
+
+        group.local_buffer.add(q_val[0], actions[0], r[0], next_obs[0], hidden[0, 0].numpy())
+
+        if done == False and group.env.steps < self.max_steps:
+            group.obs, group.hidden = next_obs, hidden
+            return
+
+        if done:
+            with self.metrics.timer('finish'):
+                data = group.local_buffer.finish()
+        else:
+            # bootstrap value of last observation, a rare call on this thread
+            _, q_val, _ = self.model.step_hidden(torch.from_numpy(next_obs.astype(np.float32)), hidden)
+            with self.metrics.timer('finish'):
+                data = group.local_buffer.finish(q_val[0])
+
+        with self.metrics.timer('backpressure'):
+            self.send(data)
+
+        with self.metrics.timer('reset'):
+            self.reset_group(group)
+
+    def reset_group(self, group:EnvGroup):
+        group.obs = group.env.reset(self.get_levels())
+        group.hidden = None
+        group.local_buffer = LocalBuffer(self.id, group.env.num_agents, group.env.map_size[0], group.obs[0])
+
+    def send(self, data:Tuple):
+        '''add episode to global buffer, wait while too many adds are in flight or the learner falls behind'''
+        if len(self.inflight_adds) >= config.max_inflight_adds:
+            ready, self.inflight_adds = runtime.wait(self.inflight_adds, num_returns=len(self.inflight_adds)-config.max_inflight_adds+1)
+            results = runtime.get(ready)
+            self.latest_level_version = max(self.latest_level_version, *[ version for _, version in results ])
+            if not all(can_insert for can_insert, _ in results):
+                while not runtime.get(self.global_buffer.can_insert.remote()):
+                    time.sleep(0.1)
+
+        self.inflight_adds.append(self.global_buffer.add.remote(data, self.record_curriculum))
+
     def update_weights(self):
         '''load weights from learner'''
-        weights_id = ray.get(self.learner.get_weights.remote())
-        weights = ray.get(weights_id)
+        weights_id = runtime.get(self.learner.get_weights.remote())
+        weights = runtime.get(weights_id)
         self.model.load_state_dict(weights)
+        if self.model.encoder_cache is not None:
+            # rate is computed from the sums over processes by MetricsExporter
+            self.metrics.count('encoder_cache_hits', self.model.encoder_cache.hits)
+            self.metrics.count('encoder_cache_lookups', self.model.encoder_cache.lookups)
     
+    def get_levels(self):
+        '''curriculum levels, fetched from the global buffer only after their version changed'''
+        if self.level_version < self.latest_level_version or self.levels is None:
+            self.level_version, self.levels = runtime.get(self.global_buffer.get_level.remote())
+        return self.levels
+
     def reset(self):
         self.model.reset()
-        level_id = ray.get(self.global_buffer.get_level.remote())
-        obs = self.env.reset(ray.get(level_id))
+        obs = self.env.reset(self.get_levels())
         local_buffer = LocalBuffer(self.id, self.env.num_agents, self.env.map_size[0], obs[0])
 
         return obs, local_buffer